@@ -0,0 +1,7 @@
+""" Reproducible benchmarks for the hot paths of a node.
+
+Run them from the repository root with ``python -m benchmarks`` (see ``--help`` for the options). The results
+are written as JSON and can be compared against a stored baseline to catch regressions.
+
+``python -m benchmarks.stress`` hammers a node from many threads and checks its state for consistency afterwards.
+"""
@@ -0,0 +1,73 @@
+""" Runs the benchmark suite and compares it with a baseline.
+
+Timings depend on the machine, so no baseline is committed; record one on the same machine first. To measure
+a change, check out the commit it is based on and store its results as the baseline, then check out the
+change and run the suite again with the same options:
+
+    git checkout <base commit>
+    python -m benchmarks --save-baseline
+    git checkout <change>
+    python -m benchmarks
+
+The second run prints the ratio of every median to the baseline and exits with 1 if a benchmark got slower
+than the tolerance allows. benchmarks/baseline.json is the default location of the baseline, see --baseline.
+"""
+
+import os
+import sys
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+
+from benchmarks import suite
+from utility.verification import Verification
+
+
+def main():
+    parser = ArgumentParser(prog='python -m benchmarks', description='Benchmarks the hot paths of a node.')
+    parser.add_argument('--blocks', type=int, default=50, help='number of synthetic blocks')
+    parser.add_argument('--txs-per-block', type=int, default=10, help='signed transactions per block')
+    parser.add_argument('--mempool', type=int, default=100, help='number of open transactions')
+    parser.add_argument('--wallets', type=int, default=4, help='number of wallets sending and receiving coins')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per benchmark')
+    parser.add_argument('--difficulty', type=int, default=Verification.DIFFICULTY, help='proof-of-work difficulty')
+    parser.add_argument('--only', action='append', help='run only this benchmark (can be given several times)')
+    parser.add_argument('--output', default='bench_results.json', help='file the results are written to')
+    parser.add_argument('--baseline', default=os.path.join('benchmarks', 'baseline.json'),
+                        help='results of an earlier run to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='accepted relative slowdown (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    Verification.DIFFICULTY = args.difficulty
+    output, baseline_path = os.path.abspath(args.output), os.path.abspath(args.baseline)
+    baseline = suite.load_report(baseline_path)
+
+    # Nodes write their files into the working directory, so the benchmarks run in a scratch directory
+    cwd = os.getcwd()
+    with TemporaryDirectory(prefix='smotcoin-bench-') as scratch:
+        os.chdir(scratch)
+        try:
+            print('Generating {} blocks with {} transactions each...'.format(args.blocks, args.txs_per_block))
+            context = suite.Context(args.blocks, args.txs_per_block, args.mempool, args.wallets, args.repeat)
+            results = suite.run_all(context, args.only)
+        finally:
+            os.chdir(cwd)
+
+    report = suite.report(context, results)
+    suite.save(output, report)
+    print('Results written to {}.'.format(output))
+    if args.save_baseline:
+        suite.save(baseline_path, report)
+        print('Baseline written to {}.'.format(baseline_path))
+        return 0
+    if baseline is None:
+        print('No baseline found at {}; record one with --save-baseline (see benchmarks/__main__.py).'.format(baseline_path))
+        return 0
+    if baseline['config'] != report['config']:
+        print('Warning: the baseline was recorded with a different configuration.')
+    regressions = suite.compare(results, baseline, args.tolerance)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
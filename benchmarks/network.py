@@ -0,0 +1,548 @@
+""" Starts a network of nodes on localhost, drives a transaction and mining workload through it and measures it.
+
+Run it from the repository root with ``python -m benchmarks.network`` (see ``--help`` for the options). Every
+node is a ``node.py`` process with its own port, wallet and data files in a scratch directory; the nodes are
+connected through ``/node`` in the chosen topology. While clients send transactions and blocks are mined,
+one observer per node polls its chain and open transactions and records when every transaction and block
+reached it. The report covers the throughput, the propagation latency of transactions and blocks, forks and
+conflict resolution, and the CPU time and memory of every node process.
+
+The resource figures are read from /proc, so the harness runs on Linux only.
+"""
+
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser
+from collections import defaultdict
+from json import dump
+from random import Random
+import re
+from tempfile import TemporaryDirectory
+from threading import Event, Lock, Thread
+from time import perf_counter, sleep, time
+
+import requests
+
+from block import Block
+from transaction import Transaction
+
+NODE_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'node.py')
+TOPOLOGIES = ['full', 'ring', 'line', 'star', 'random']
+# The number of blocks at the tip an observer compares to detect that its node switched to another branch
+REORG_WINDOW = 20
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+METRIC_LINE = re.compile(r'^(\w+)(?:\{([^}]*)\})? (\S+)$')
+
+
+def topology_edges(name, count, degree, rng):
+    """ Returns the (a, b) pairs of node numbers which are connected in both directions.
+
+    Arguments:
+        name: One of TOPOLOGIES.
+        count: The number of nodes.
+        degree: The average number of peers per node of the random topology.
+        rng: The random generator of the random topology.
+    """
+    if name == 'full':
+        return [(a, b) for a in range(count) for b in range(a + 1, count)]
+    if name == 'ring':
+        return [(a, (a + 1) % count) for a in range(count)] if count > 2 else topology_edges('line', count, degree, rng)
+    if name == 'line':
+        return [(a, a + 1) for a in range(count - 1)]
+    if name == 'star':
+        return [(0, b) for b in range(1, count)]
+    # A random spanning tree keeps the network connected, random extra edges bring it up to the degree
+    edges = {(rng.randrange(b), b) for b in range(1, count)}
+    possible = count * (count - 1) // 2
+    while len(edges) < min(possible, count * degree // 2):
+        a, b = sorted(rng.sample(range(count), 2))
+        edges.add((a, b))
+    return sorted(edges)
+
+
+def distribution(values):
+    """ Returns the runs, min, median, p95, mean and max of the given values, or None if there are none. """
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        'runs': len(values),
+        'min': values[0],
+        'median': values[len(values) // 2],
+        'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+        'mean': sum(values) / len(values),
+        'max': values[-1]
+    }
+
+
+class NodeProcess:
+    """ A node.py process which listens on a port of localhost and keeps its files in its own directory. """
+
+    def __init__(self, number, port, directory, difficulty):
+        self.number = number
+        self.port = port
+        self.address = 'localhost:{}'.format(port)
+        self.directory = directory
+        self.difficulty = difficulty
+        self.session = requests.Session()
+        self.process = None
+        self.public_key = None
+
+    def url(self, path):
+        return 'http://{}{}'.format(self.address, path)
+
+    def get(self, path, **kwargs):
+        return self.session.get(self.url(path), timeout=10, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.session.post(self.url(path), timeout=60, **kwargs)
+
+    def start(self):
+        os.makedirs(self.directory)
+        log = open(os.path.join(self.directory, 'node.log'), mode='w')
+        self.process = subprocess.Popen([sys.executable, NODE_SCRIPT, '-p', str(self.port), '--difficulty', str(self.difficulty)],
+                                        cwd=self.directory, stdout=log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout=30):
+        deadline = perf_counter() + timeout
+        while perf_counter() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError('Node {} exited, see {}.'.format(self.port, os.path.join(self.directory, 'node.log')))
+            try:
+                self.get('/chain/head')
+                return
+            except requests.RequestException:
+                sleep(0.1)
+        raise RuntimeError('Node {} did not start in time.'.format(self.port))
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+    def resources(self):
+        """ Returns the CPU seconds (including finished mining processes) and the memory of the process from /proc. """
+        with open('/proc/{}/stat'.format(self.process.pid)) as file:
+            # The command name may contain spaces, the fields after it don't
+            fields = file.read().rsplit(')', 1)[1].split()
+        utime, stime, cutime, cstime = (int(value) for value in fields[11:15])
+        memory = {}
+        with open('/proc/{}/status'.format(self.process.pid)) as file:
+            for line in file:
+                name, _, value = line.partition(':')
+                if name in ('VmRSS', 'VmHWM'):
+                    memory[name] = int(value.split()[0]) * 1024
+        disk = sum(os.path.getsize(os.path.join(self.directory, name)) for name in os.listdir(self.directory))
+        return {
+            'cpu_seconds': (utime + stime + cutime + cstime) / CLOCK_TICKS,
+            'rss_bytes': memory.get('VmRSS'),
+            'peak_rss_bytes': memory.get('VmHWM'),
+            'disk_bytes': disk
+        }
+
+    def metrics(self):
+        """ Returns the values of the node's metrics, with the values of labelled metrics summed up. """
+        values = defaultdict(float)
+        for line in self.get('/metrics').text.splitlines():
+            match = METRIC_LINE.match(line)
+            if match:
+                values[match.group(1)] += float(match.group(3))
+        return values
+
+
+class Recorder:
+    """ Collects the times at which transactions were sent and transactions and blocks were seen by the nodes.
+
+    Attributes:
+
+    - sent: The time every transaction was sent, by its digest.
+    - created: The timestamp of every block, by its hash.
+    - transactions_seen: The time every node first saw a transaction, by digest and node number.
+    - blocks_seen: The time every node first saw a block, by hash and node number.
+    - heights: The hashes of all blocks seen at a height, by the height.
+    - reorgs: The depths of the branch switches seen on a node, by node number.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.sent = {}
+        self.created = {}
+        self.transactions_seen = defaultdict(dict)
+        self.blocks_seen = defaultdict(dict)
+        self.heights = defaultdict(set)
+        self.reorgs = defaultdict(list)
+
+    def transaction_sent(self, digest, started):
+        with self.lock:
+            self.sent.setdefault(digest, started)
+
+    def transaction_seen(self, digest, node, seen):
+        with self.lock:
+            self.transactions_seen[digest].setdefault(node, seen)
+
+    def block_seen(self, block, node, seen):
+        digests = [tx.digest for tx in block.transactions[:-1]]
+        with self.lock:
+            self.blocks_seen[block.hash].setdefault(node, seen)
+            self.created.setdefault(block.hash, block.timestamp)
+            self.heights[block.index].add(block.hash)
+            for digest in digests:
+                self.transactions_seen[digest].setdefault(node, seen)
+
+    def reorg(self, node, depth):
+        with self.lock:
+            self.reorgs[node].append(depth)
+
+
+class Observer(Thread):
+    """ Polls a node and records when new transactions and blocks show up on it.
+
+    The timestamps are taken when a poll returns, so they are late by up to the poll interval plus the time
+    the poll takes.
+    """
+
+    def __init__(self, node, recorder, interval, stopped):
+        super().__init__(daemon=True)
+        self.node = node
+        self.recorder = recorder
+        self.interval = interval
+        self.stopped = stopped
+        self.hashes = node.get('/chain/hashes').json()
+        self.tip_hash = self.hashes[-1]
+        self.errors = 0
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.poll()
+            except (requests.RequestException, ValueError):
+                self.errors += 1
+            self.stopped.wait(self.interval)
+
+    def poll(self):
+        seen = time()
+        for tx in self.node.get('/transactions').json():
+            self.recorder.transaction_seen(Transaction.from_dict(tx).digest, self.node.number, seen)
+        head = self.node.get('/chain/head').json()
+        if head['tip_hash'] == self.tip_hash:
+            return
+        start = max(len(self.hashes) - REORG_WINDOW, 0)
+        hashes = self.node.get('/chain/hashes', params={'from': start}).json()
+        if start and hashes[:1] != self.hashes[start:start + 1]:
+            # The node switched to a branch which forked off below the window
+            start, hashes = 0, self.node.get('/chain/hashes').json()
+        changed = start
+        while changed - start < len(hashes) and changed < len(self.hashes) and hashes[changed - start] == self.hashes[changed]:
+            changed += 1
+        if changed < len(self.hashes):
+            self.recorder.reorg(self.node.number, len(self.hashes) - changed)
+        blocks = [Block.from_dict(block) for block in self.node.get('/chain', params={'from': changed}).json()]
+        seen = time()
+        for block in blocks:
+            self.recorder.block_seen(block, self.node.number, seen)
+        self.hashes = self.hashes[:changed] + [block.hash for block in blocks]
+        self.tip_hash = self.hashes[-1]
+
+
+class TransactionClient(Thread):
+    """ Sends transactions between the wallets of random nodes at a fixed rate until the workload stops. """
+
+    def __init__(self, nodes, recorder, rate, seed, stopped):
+        super().__init__(daemon=True)
+        self.nodes = nodes
+        self.recorder = recorder
+        self.interval = 1 / rate if rate > 0 else None
+        self.rng = Random(seed)
+        self.stopped = stopped
+        self.statuses = defaultdict(int)
+        self.errors = []
+
+    def run(self):
+        if self.interval is None:
+            return
+        next_send = perf_counter()
+        while not self.stopped.is_set():
+            sender, recipient = self.rng.sample(self.nodes, 2)
+            # Signatures are deterministic, so equal payments would be the same transaction
+            amount = round(self.rng.uniform(0.001, 0.01), 9)
+            started = time()
+            try:
+                response = sender.post('/transaction', json={'recipient': recipient.public_key, 'amount': amount})
+            except requests.RequestException as error:
+                self.errors.append(repr(error))
+            else:
+                self.statuses[response.status_code] += 1
+                if response.status_code == 201:
+                    digest = Transaction.from_dict(response.json()['transaction']).digest
+                    self.recorder.transaction_sent(digest, started)
+                    self.recorder.transaction_seen(digest, sender.number, time())
+            next_send += self.interval
+            self.stopped.wait(max(next_send - perf_counter(), 0))
+
+
+class BlockClient(Thread):
+    """ Asks a random node to mine a block at a fixed interval until the workload stops. """
+
+    def __init__(self, nodes, interval, seed, stopped):
+        super().__init__(daemon=True)
+        self.nodes = nodes
+        self.interval = interval
+        self.rng = Random(seed)
+        self.stopped = stopped
+        self.statuses = defaultdict(int)
+        self.errors = []
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.statuses[self.rng.choice(self.nodes).post('/mine').status_code] += 1
+            except requests.RequestException as error:
+                self.errors.append(repr(error))
+
+
+def wait_for_convergence(nodes, timeout):
+    """ Waits until all nodes have the same tip, and returns whether they got there in time. """
+    deadline = perf_counter() + timeout
+    while True:
+        tips = set()
+        for node in nodes:
+            try:
+                tips.add(node.get('/chain/head').json()['tip_hash'])
+            except requests.RequestException:
+                tips.add(None)
+        if len(tips) == 1 and None not in tips:
+            return True
+        if perf_counter() >= deadline:
+            return False
+        sleep(0.2)
+
+
+def propagation(first_times, seen, nodes):
+    """ Returns the latencies until every other node saw an item, and until the last node saw it.
+
+    Arguments:
+        first_times: The time every item was created, by its id.
+        seen: The times at which the nodes saw an item, by the id of the item and the number of the node.
+        nodes: The number of nodes.
+    """
+    per_node, complete, missing = [], [], 0
+    for item, created in first_times.items():
+        times = seen.get(item, {})
+        per_node.extend(max(at - created, 0) for at in times.values())
+        if len(times) == nodes:
+            complete.append(max(max(times.values()) - created, 0))
+        else:
+            missing += 1
+    return {'per_node': distribution(per_node), 'all_nodes': distribution(complete), 'not_seen_by_all': missing}
+
+
+def bootstrap(nodes, edges, warmup_blocks, timeout):
+    """ Creates the wallets, connects the nodes and mines blocks on every node, so all of them have coins. """
+    for node in nodes:
+        response = node.post('/wallet')
+        node.public_key = response.json()['public_key']
+    for a, b in edges:
+        nodes[a].post('/node', json={'node': nodes[b].address})
+        nodes[b].post('/node', json={'node': nodes[a].address})
+    for _ in range(warmup_blocks):
+        for node in nodes:
+            node.post('/mine')
+            if not wait_for_convergence(nodes, timeout):
+                node.post('/resolve-conflicts')
+
+
+def run_workload(nodes, args):
+    """ Runs the workload on the bootstrapped nodes and returns the report. """
+    recorder = Recorder()
+    stopped, observers_stopped = Event(), Event()
+    observers = [Observer(node, recorder, args.poll_interval, observers_stopped) for node in nodes]
+    known_before = {block_hash for observer in observers for block_hash in observer.hashes}
+    start_height = len(observers[0].hashes)
+    resources_before = [node.resources() for node in nodes]
+    metrics_before = [node.metrics() for node in nodes]
+    clients = [TransactionClient(nodes, recorder, args.tx_rate / args.clients, args.seed + number, stopped)
+               for number in range(args.clients)]
+    block_client = BlockClient(nodes, args.block_interval, args.seed, stopped) if args.block_interval > 0 else None
+
+    print('Running the workload for {} seconds...'.format(args.seconds))
+    for observer in observers:
+        observer.start()
+    for node in nodes[:args.miners]:
+        node.post('/miner/start')
+    started = perf_counter()
+    for client in clients + ([block_client] if block_client else []):
+        client.start()
+    sleep(args.seconds)
+    stopped.set()
+    for client in clients + ([block_client] if block_client else []):
+        client.join()
+    duration = perf_counter() - started
+    for node in nodes[:args.miners]:
+        node.post('/miner/stop')
+
+    converged = wait_for_convergence(nodes, args.settle)
+    # One more round of polls, so the observers saw the chains the network settled on by itself
+    sleep(args.poll_interval * 2 + 0.5)
+    observers_stopped.set()
+    for observer in observers:
+        observer.join()
+    metrics_after = [node.metrics() for node in nodes]
+    # Nodes only resolve on their own while they mine or receive blocks, so a split which is left over is resolved
+    # explicitly (outside of the measurements) to tell it apart from chains which can't be reconciled
+    converged_after_resolve = converged
+    if not converged:
+        for node in nodes:
+            node.post('/resolve-conflicts')
+        converged_after_resolve = wait_for_convergence(nodes, args.settle)
+
+    final_chain = [Block.from_dict(block) for block in nodes[0].get('/chain', params={'from': start_height}).json()]
+    final_hashes = set(nodes[0].get('/chain/hashes').json())
+    confirmed = {tx.digest for block in final_chain for tx in block.transactions[:-1]}
+    new_blocks = set(recorder.created) - known_before
+    tx_statuses, block_statuses, errors = defaultdict(int), defaultdict(int), []
+    for client in clients:
+        errors.extend(client.errors)
+        for status, count in client.statuses.items():
+            tx_statuses[str(status)] += count
+    if block_client:
+        errors.extend(block_client.errors)
+        for status, count in block_client.statuses.items():
+            block_statuses[str(status)] += count
+
+    node_reports = []
+    for node, observer, before, metrics_start, metrics_end in zip(nodes, observers, resources_before, metrics_before, metrics_after):
+        after = node.resources()
+        delta = defaultdict(float, {name: value - metrics_start[name] for name, value in metrics_end.items()})
+        node_reports.append({
+            'port': node.port,
+            'peers': len(node.get('/nodes').json()['all_nodes']),
+            'height': len(observer.hashes),
+            'cpu_seconds': after['cpu_seconds'] - before['cpu_seconds'],
+            'cpu_percent': 100 * (after['cpu_seconds'] - before['cpu_seconds']) / duration,
+            'rss_bytes': after['rss_bytes'],
+            'peak_rss_bytes': after['peak_rss_bytes'],
+            'disk_bytes': after['disk_bytes'],
+            'conflicts': int(delta['smotcoin_conflicts_total']),
+            'resolves': int(delta['smotcoin_resolve_seconds_count']),
+            'chain_replacements': int(delta['smotcoin_chain_replacements_total']),
+            'reorgs': len(recorder.reorgs[node.number]),
+            'max_reorg_depth': max(recorder.reorgs[node.number], default=0),
+            'mining_rounds_cancelled': int(delta['smotcoin_mining_rounds_cancelled_total']),
+            'observer_errors': observer.errors
+        })
+
+    accepted = sum(count for status, count in tx_statuses.items() if status == '201')
+    confirmed_sent = len(confirmed & set(recorder.sent))
+    report = {
+        'duration': duration,
+        'converged': converged,
+        'converged_after_resolve': converged_after_resolve,
+        'throughput': {
+            'transactions_sent': sum(tx_statuses.values()),
+            'transactions_accepted': accepted,
+            'accepted_per_second': accepted / duration,
+            'transactions_confirmed': confirmed_sent,
+            'confirmed_per_second': confirmed_sent / duration,
+            'blocks': len(final_chain),
+            'blocks_per_second': len(final_chain) / duration,
+            'transaction_statuses': dict(tx_statuses),
+            'mine_statuses': dict(block_statuses)
+        },
+        'propagation': {
+            'transactions': propagation(recorder.sent, recorder.transactions_seen, len(nodes)),
+            'blocks': propagation({block_hash: recorder.created[block_hash] for block_hash in new_blocks}, recorder.blocks_seen, len(nodes))
+        },
+        'forks': {
+            'heights_with_competing_blocks': sum(1 for hashes in recorder.heights.values() if len(hashes) > 1),
+            'stale_blocks': len(new_blocks - final_hashes),
+            'reorgs': sum(len(depths) for depths in recorder.reorgs.values()),
+            'conflicts': sum(node['conflicts'] for node in node_reports),
+            'resolves': sum(node['resolves'] for node in node_reports),
+            'chain_replacements': sum(node['chain_replacements'] for node in node_reports)
+        },
+        'nodes': node_reports,
+        'errors': errors[:20]
+    }
+    print_report(report)
+    return report
+
+
+def print_report(report):
+    throughput, forks = report['throughput'], report['forks']
+    print('Converged: {} (after resolving: {})'.format(report['converged'], report['converged_after_resolve']))
+    print('Transactions: {} sent, {:.1f}/s accepted, {:.1f}/s confirmed, statuses {}'.format(
+        throughput['transactions_sent'], throughput['accepted_per_second'], throughput['confirmed_per_second'], throughput['transaction_statuses']))
+    print('Blocks: {} ({:.2f}/s), /mine statuses {}'.format(throughput['blocks'], throughput['blocks_per_second'], throughput['mine_statuses']))
+    for name, latencies in report['propagation'].items():
+        complete = latencies['all_nodes']
+        if complete is None:
+            print('{:<13} propagation: no item reached every node'.format(name.capitalize()))
+        else:
+            print('{:<13} propagation to all nodes: median {:.3f}s  p95 {:.3f}s  max {:.3f}s  ({} not seen by all)'.format(
+                name.capitalize(), complete['median'], complete['p95'], complete['max'], latencies['not_seen_by_all']))
+    print('Forks: {} contested heights, {} stale blocks, {} reorgs, {} conflicts, {} resolves, {} chain replacements'.format(
+        forks['heights_with_competing_blocks'], forks['stale_blocks'], forks['reorgs'], forks['conflicts'], forks['resolves'],
+        forks['chain_replacements']))
+    print('{:>6} {:>6} {:>7} {:>8} {:>7} {:>10} {:>10} {:>9}'.format('port', 'peers', 'height', 'cpu s', 'cpu %', 'rss MB', 'peak MB', 'disk KB'))
+    for node in report['nodes']:
+        print('{:>6} {:>6} {:>7} {:>8.2f} {:>7.1f} {:>10.1f} {:>10.1f} {:>9.1f}'.format(
+            node['port'], node['peers'], node['height'], node['cpu_seconds'], node['cpu_percent'], node['rss_bytes'] / 2 ** 20,
+            node['peak_rss_bytes'] / 2 ** 20, node['disk_bytes'] / 1024))
+
+
+def main():
+    parser = ArgumentParser(prog='python -m benchmarks.network', description='Measures a network of local nodes under load.')
+    parser.add_argument('--nodes', type=int, default=4, help='number of node processes')
+    parser.add_argument('--topology', choices=TOPOLOGIES, default='ring', help='how the nodes are connected')
+    parser.add_argument('--degree', type=int, default=3, help='average number of peers of the random topology')
+    parser.add_argument('--base-port', type=int, default=5200, help='port of the first node, the others follow')
+    parser.add_argument('--seconds', type=float, default=20, help='duration of the workload')
+    parser.add_argument('--tx-rate', type=float, default=10, help='transactions per second, spread over the clients')
+    parser.add_argument('--clients', type=int, default=2, help='number of threads sending transactions')
+    parser.add_argument('--block-interval', type=float, default=2, help='seconds between /mine requests to a random node (0 = none)')
+    parser.add_argument('--miners', type=int, default=0, help='number of nodes which run the background miner')
+    parser.add_argument('--difficulty', type=int, default=3, help='proof-of-work difficulty of the nodes')
+    parser.add_argument('--warmup-blocks', type=int, default=2, help='blocks every node mines before the workload, for coins')
+    parser.add_argument('--poll-interval', type=float, default=0.05, help='seconds between two polls of an observer')
+    parser.add_argument('--settle', type=float, default=30, help='seconds to wait for the nodes to agree after the workload')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the topology and the workload')
+    parser.add_argument('--keep', help='keep the node directories in this directory instead of a temporary one')
+    parser.add_argument('--output', default='network_results.json', help='file the results are written to')
+    args = parser.parse_args()
+    if args.nodes < 2:
+        parser.error('at least 2 nodes are needed')
+
+    rng = Random(args.seed)
+    edges = topology_edges(args.topology, args.nodes, args.degree, rng)
+    output = os.path.abspath(args.output)
+    with TemporaryDirectory(prefix='smotcoin-network-') as scratch:
+        base = os.path.abspath(args.keep) if args.keep else scratch
+        nodes = [NodeProcess(number, args.base_port + number, os.path.join(base, str(args.base_port + number)), args.difficulty)
+                 for number in range(args.nodes)]
+        try:
+            print('Starting {} nodes ({} topology, {} links)...'.format(args.nodes, args.topology, len(edges)))
+            for node in nodes:
+                node.start()
+            for node in nodes:
+                node.wait_ready()
+            bootstrap(nodes, edges, args.warmup_blocks, args.settle)
+            report = run_workload(nodes, args)
+        finally:
+            for node in nodes:
+                node.stop()
+
+    report['config'] = vars(args)
+    report['edges'] = edges
+    with open(output, mode='w') as file:
+        dump(report, file, indent=2)
+    print('Results written to {}.'.format(output))
+    return 0 if report['converged_after_resolve'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,221 @@
+""" Hammers a node with concurrent requests from many threads and checks that its state stayed consistent.
+
+Run it from the repository root with ``python -m benchmarks.stress`` (see ``--help`` for the options). The node
+runs on a threaded HTTP server in the same process, in a scratch directory. Once all clients are done, the
+chain, balances, open transactions and indexes in memory are compared with each other and with a node loaded
+from disk; the exit code is 1 if any check failed.
+"""
+
+import os
+import sys
+from argparse import ArgumentParser
+from collections import defaultdict
+from json import dump
+import logging
+from random import Random
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter
+
+from flask import got_request_exception
+import requests
+from werkzeug.serving import make_server
+
+from benchmarks.suite import summarize
+from benchmarks.synthetic import create_wallets
+from blockchain import Blockchain
+import node
+from utility.ledger import Ledger
+from utility.mining import BackgroundMiner
+from utility.tx_index import TransactionIndex
+from utility.verification import Verification
+
+# Relative weights of the requests the clients send
+OPERATIONS = [
+    ('POST /transaction', 4),
+    ('POST /broadcast_transaction', 4),
+    ('POST /transactions/batch', 1),
+    ('POST /mine', 1),
+    ('GET /chain', 2),
+    ('GET /chain/head', 3),
+    ('GET /balance', 3),
+    ('GET /transactions', 2),
+    ('GET /address/<key>/transactions', 2)
+]
+
+
+class Client:
+    """ Sends random requests to the node until the deadline and records the status codes and durations. """
+
+    def __init__(self, base_url, wallets, seed, deadline):
+        self.base_url = base_url
+        self.wallets = wallets
+        self.rng = Random(seed)
+        self.deadline = deadline
+        self.session = requests.Session()
+        self.durations = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.errors = []
+
+    def run(self):
+        names = [name for name, _ in OPERATIONS]
+        weights = [weight for _, weight in OPERATIONS]
+        while perf_counter() < self.deadline:
+            name = self.rng.choices(names, weights)[0]
+            started = perf_counter()
+            try:
+                status = self.send(name)
+            except requests.RequestException as error:
+                self.errors.append('{}: {}'.format(name, error))
+                continue
+            self.durations[name].append(perf_counter() - started)
+            self.statuses[name][status] += 1
+
+    def amount(self):
+        # Signatures are deterministic, so equal payments would be the same transaction; random amounts keep
+        # them apart
+        return round(self.rng.uniform(0.01, 1), 9)
+
+    def send(self, name):
+        method, path = name.split(' ')
+        url = self.base_url + path
+        if name == 'POST /transaction':
+            recipient = self.rng.choice(self.wallets[1:])
+            return self.session.post(url, json={'recipient': recipient.public_key, 'amount': self.amount()}).status_code
+        if name == 'POST /broadcast_transaction':
+            sender, recipient = self.rng.sample(self.wallets, 2)
+            amount = self.amount()
+            signature = sender.sign_transaction(sender.public_key, recipient.public_key, amount)
+            payload = {'sender': sender.public_key, 'recipient': recipient.public_key, 'amount': amount, 'signature': signature}
+            return self.session.post(url, json=payload).status_code
+        if name == 'POST /transactions/batch':
+            items = [{'recipient': self.rng.choice(self.wallets[1:]).public_key, 'amount': self.amount()} for _ in range(5)]
+            return self.session.post(url, json={'transactions': items}).status_code
+        if name == 'GET /chain':
+            return self.session.get(url, params={'offset': self.rng.randrange(0, 50), 'limit': 20}).status_code
+        if name == 'GET /address/<key>/transactions':
+            url = self.base_url + '/address/{}/transactions'.format(self.rng.choice(self.wallets).public_key)
+            return self.session.get(url, params={'limit': 20}).status_code
+        response = self.session.request(method, url)
+        response.content
+        return response.status_code
+
+
+def check(name, passed, checks):
+    checks[name] = bool(passed)
+    print('{:<40} {}'.format(name, 'ok' if passed else 'FAILED'))
+
+
+def check_state(blockchain, wallets):
+    """ Compares the state of a node in memory with itself and with a copy loaded from disk. """
+    checks = {}
+    chain = blockchain.chain
+    open_transactions = blockchain.open_transactions
+    keys = [wallet.public_key for wallet in wallets]
+    check('chain is valid', Verification.verify_chain(chain), checks)
+
+    ledger = Ledger()
+    ledger.rebuild(chain, open_transactions)
+    check('balances match the chain', all(abs(ledger.balance(key) - blockchain.get_balance(key)) < 1e-6 for key in keys), checks)
+
+    confirmed = [tx.digest for block in chain for tx in block.transactions[:-1]]
+    check('no transaction was confirmed twice', len(confirmed) == len(set(confirmed)), checks)
+    check('no confirmed transaction is pending', not set(confirmed) & {tx.digest for tx in open_transactions}, checks)
+
+    index = TransactionIndex()
+    index.rebuild(chain)
+    check('address index matches the chain', all(index.address_positions(key) == blockchain.address_positions(key)[1] for key in keys), checks)
+
+    reloaded = Blockchain(None, blockchain.node_id)
+    check('stored chain matches memory', [block.hash for block in reloaded.chain] == [block.hash for block in chain], checks)
+    check('stored mempool matches memory', [tx.digest for tx in reloaded.open_transactions] == [tx.digest for tx in open_transactions], checks)
+    check('stored balances match memory', all(abs(reloaded.get_balance(key) - blockchain.get_balance(key)) < 1e-6 for key in keys), checks)
+    return checks
+
+
+def main():
+    parser = ArgumentParser(prog='python -m benchmarks.stress', description='Hammers a node from many threads.')
+    parser.add_argument('--threads', type=int, default=16, help='number of client threads')
+    parser.add_argument('--seconds', type=float, default=10, help='duration of the run')
+    parser.add_argument('--wallets', type=int, default=4, help='number of wallets sending and receiving coins')
+    parser.add_argument('--difficulty', type=int, default=2, help='proof-of-work difficulty')
+    parser.add_argument('--miner', action='store_true', help='run the background miner during the test')
+    parser.add_argument('--output', default='stress_results.json', help='file the results are written to')
+    args = parser.parse_args()
+
+    Verification.DIFFICULTY = args.difficulty
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    output = os.path.abspath(args.output)
+    cwd = os.getcwd()
+    with TemporaryDirectory(prefix='smotcoin-stress-') as scratch:
+        os.chdir(scratch)
+        try:
+            wallets = create_wallets(args.wallets)
+            node.port = 'stress'
+            node.wallet = wallets[0]
+            node.blockchain = Blockchain(wallets[0].public_key, node.port)
+            node.miner = BackgroundMiner(node.blockchain)
+            # Funds for the wallets, so most transactions are accepted
+            for _ in range(10):
+                node.blockchain.mine_block()
+            for wallet in wallets[1:]:
+                node.blockchain.add_transaction(wallet.public_key, wallets[0].public_key,
+                                                wallets[0].sign_transaction(wallets[0].public_key, wallet.public_key, 20), 20)
+            node.blockchain.mine_block()
+
+            # Declined transactions are answered with 500 as well, so crashes are counted through Flask's signal
+            exceptions = []
+            got_request_exception.connect(lambda sender, exception, **extra: exceptions.append(repr(exception)), node.app, weak=False)
+            server = make_server('127.0.0.1', 0, node.app, threaded=True)
+            server_thread = Thread(target=server.serve_forever, daemon=True)
+            server_thread.start()
+            if args.miner:
+                node.miner.start()
+            base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+            print('Sending requests from {} threads for {} seconds...'.format(args.threads, args.seconds))
+            deadline = perf_counter() + args.seconds
+            clients = [Client(base_url, wallets, seed, deadline) for seed in range(args.threads)]
+            threads = [Thread(target=client.run) for client in clients]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            node.miner.stop()
+            server.shutdown()
+
+            checks = check_state(node.blockchain, wallets)
+        finally:
+            os.chdir(cwd)
+
+    durations, statuses, errors = defaultdict(list), defaultdict(lambda: defaultdict(int)), []
+    for client in clients:
+        errors.extend(client.errors)
+        for name, values in client.durations.items():
+            durations[name].extend(values)
+        for name, counts in client.statuses.items():
+            for status, count in counts.items():
+                statuses[name][status] += count
+    operations = {}
+    for name, values in durations.items():
+        operations[name] = dict(summarize(values), statuses={str(status): count for status, count in statuses[name].items()},
+                                per_second=len(values) / args.seconds)
+        print('{:<36} {:>6} requests  median {:>8.4f}s  {}'.format(name, len(values), operations[name]['median'], dict(statuses[name])))
+    errors.extend(exceptions)
+    check('no request failed', not errors, checks)
+
+    report = {
+        'config': vars(args),
+        'height': node.blockchain.height,
+        'requests': sum(len(values) for values in durations.values()),
+        'operations': operations,
+        'errors': errors[:20],
+        'checks': checks
+    }
+    with open(output, mode='w') as file:
+        dump(report, file, indent=2)
+    print('Results written to {}.'.format(output))
+    return 0 if all(checks.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
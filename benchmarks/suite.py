@@ -0,0 +1,229 @@
+""" Provides the benchmarks and helpers to time them, store their results and compare them with a baseline. """
+
+from collections import OrderedDict
+from json import dump, load
+import os
+import platform
+from statistics import mean, median
+from time import perf_counter, time
+
+from benchmarks.synthetic import create_chain, create_transactions, create_wallets, store_chain
+from blockchain import Blockchain
+import node
+from utility import codec
+from utility.storage import BlockStore
+from utility.verification import Verification
+
+
+class Context:
+    """ The synthetic data shared by all benchmarks.
+
+    Attributes:
+
+    - blocks: The number of blocks after the genesis block.
+    - transactions_per_block: The number of signed transactions per block.
+    - mempool: The number of signed open transactions.
+    - repeat: How often every benchmark is run.
+    """
+
+    def __init__(self, blocks, transactions_per_block, mempool, wallets, repeat):
+        self.blocks = blocks
+        self.transactions_per_block = transactions_per_block
+        self.mempool = mempool
+        self.repeat = repeat
+        self.wallets = create_wallets(wallets)
+        self.chain = create_chain(self.wallets, blocks, transactions_per_block)
+        self.open_transactions = create_transactions(self.wallets, mempool, seed=1)
+        self.__next_node_id = 0
+
+    def blockchain(self, chain=None, open_transactions=None):
+        """ Stores the given (default: the synthetic) chain and mempool under a new node id and loads it. """
+        self.__next_node_id += 1
+        store_chain(self.__next_node_id, self.chain if chain is None else chain,
+                    self.open_transactions if open_transactions is None else open_transactions)
+        return Blockchain(self.wallets[0].public_key, self.__next_node_id)
+
+    def fresh_chain(self):
+        """ Returns a copy of the synthetic chain whose blocks haven't memoized their hashes yet. """
+        return codec.decode_chain(codec.encode_chain(self.chain))
+
+
+def run(function, repeat, setup=None):
+    """ Returns the durations of repeated calls of a function.
+
+    Arguments:
+        function: The function to time; it receives the return value of setup, if there is one.
+        repeat: The number of runs.
+        setup: A function which prepares every run and isn't timed (optional).
+    """
+    durations = []
+    for _ in range(repeat):
+        args = () if setup is None else (setup(),)
+        started = perf_counter()
+        function(*args)
+        durations.append(perf_counter() - started)
+    return durations
+
+
+def bench_proof_of_work(context):
+    blockchain = context.blockchain()
+    # Every run gets a fresh timestamp, which the proof covers
+    return run(blockchain.proof_of_work, context.repeat, setup=time)
+
+
+def bench_verify_chain_cold(context):
+    def setup():
+        Verification.forget_verified()
+        return context.fresh_chain()
+    return run(Verification.verify_chain, context.repeat, setup)
+
+
+def bench_verify_chain_cached(context):
+    chain = context.fresh_chain()
+    Verification.verify_chain(chain)
+    return run(lambda: Verification.verify_chain(chain), context.repeat)
+
+
+def bench_get_balance_1000(context):
+    blockchain = context.blockchain()
+    keys = [wallet.public_key for wallet in context.wallets]
+
+    def lookups():
+        for number in range(1000):
+            blockchain.get_balance(keys[number % len(keys)])
+    return run(lookups, context.repeat)
+
+
+def bench_save_data(context):
+    blockchain = context.blockchain()
+    return run(blockchain.save_data, context.repeat)
+
+
+def bench_append_block(context):
+    store = BlockStore(context.blockchain().node_id)
+    return run(lambda: store.append_block(context.chain[-1]), context.repeat)
+
+
+def bench_load_data(context):
+    blockchain = context.blockchain()
+    return run(lambda: Blockchain(None, blockchain.node_id), context.repeat)
+
+
+def bench_add_block(context):
+    """ Times add_block for the last synthetic block while its transactions are pending in a full mempool. """
+    last_block = context.chain[-1]
+
+    def setup():
+        open_transactions = list(last_block.transactions[:-1]) + context.open_transactions
+        return context.blockchain(context.chain[:-1], open_transactions)
+    return run(lambda blockchain: blockchain.add_block(last_block), context.repeat, setup)
+
+
+def endpoint_benchmark(path, headers=None):
+    """ Returns a benchmark which requests a route of the node through the Flask test client. """
+    def bench(context):
+        node.port = 'bench'
+        node.wallet = context.wallets[0]
+        node.blockchain = context.blockchain()
+        client = node.app.test_client()
+
+        def request():
+            response = client.get(path, headers=headers)
+            response.get_data()
+            assert response.status_code == 200, response.status_code
+        return run(request, context.repeat)
+    return bench
+
+
+BENCHMARKS = OrderedDict([
+    ('proof_of_work', bench_proof_of_work),
+    ('verify_chain_cold', bench_verify_chain_cold),
+    ('verify_chain_cached', bench_verify_chain_cached),
+    ('get_balance_1000', bench_get_balance_1000),
+    ('save_data', bench_save_data),
+    ('append_block', bench_append_block),
+    ('load_data', bench_load_data),
+    ('add_block', bench_add_block),
+    ('GET /chain', endpoint_benchmark('/chain')),
+    ('GET /chain (binary)', endpoint_benchmark('/chain', {'Accept': codec.CONTENT_TYPE})),
+    ('GET /chain/head', endpoint_benchmark('/chain/head')),
+    ('GET /transactions', endpoint_benchmark('/transactions')),
+    ('GET /balance', endpoint_benchmark('/balance')),
+])
+
+
+def summarize(durations):
+    return {
+        'runs': len(durations),
+        'min': min(durations),
+        'median': median(durations),
+        'mean': mean(durations),
+        'max': max(durations)
+    }
+
+
+def run_all(context, names=None):
+    """ Runs the selected (default: all) benchmarks in the current directory and returns their summaries. """
+    results = OrderedDict()
+    for name, bench in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        results[name] = summarize(bench(context))
+        print('{:<24} median {:>10.6f}s  min {:>10.6f}s'.format(name, results[name]['median'], results[name]['min']))
+    return results
+
+
+def report(context, results):
+    """ Returns the machine-readable report of a run. """
+    return {
+        'config': {
+            'blocks': context.blocks,
+            'transactions_per_block': context.transactions_per_block,
+            'mempool': context.mempool,
+            'wallets': len(context.wallets),
+            'repeat': context.repeat,
+            'difficulty': Verification.DIFFICULTY
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()
+        },
+        'benchmarks': results
+    }
+
+
+def save(path, data):
+    with open(path, mode='w') as file:
+        dump(data, file, indent=2)
+
+
+def load_report(path):
+    try:
+        with open(path, mode='r') as file:
+            return load(file)
+    except (IOError, ValueError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """ Compares the medians of a run with a baseline report.
+
+    Arguments:
+        results: The summaries of the current run.
+        baseline: A report written by an earlier run.
+        tolerance: The relative slowdown which is still accepted, e.g. 0.25 for 25%.
+
+    :return: The names of the benchmarks which regressed.
+    """
+    regressions = []
+    for name, summary in results.items():
+        reference = baseline['benchmarks'].get(name)
+        if reference is None or reference['median'] <= 0:
+            continue
+        ratio = summary['median'] / reference['median']
+        regressed = ratio > 1 + tolerance
+        if regressed:
+            regressions.append(name)
+        print('{:<24} {:>7.2f}x baseline{}'.format(name, ratio, '  REGRESSION' if regressed else ''))
+    return regressions
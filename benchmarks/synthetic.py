@@ -0,0 +1,71 @@
+""" Generates synthetic chains and mempools which are signed with real wallet keys. """
+
+from random import Random
+
+from block import Block
+from blockchain import Blockchain
+from transaction import Transaction
+from utility.merkle import merkle_root
+from utility.mining import ProofOfWork
+from utility.storage import BlockStore
+from wallet import Wallet
+
+
+def create_wallets(count):
+    """ Returns the given number of wallets with freshly generated keys (which are not saved). """
+    wallets = []
+    for node_id in range(count):
+        wallet = Wallet(node_id)
+        wallet.create_keys()
+        wallets.append(wallet)
+    return wallets
+
+
+def create_transactions(wallets, count, seed=0):
+    """ Returns signed transactions of small amounts between random wallets.
+
+    Arguments:
+        wallets: The wallets which send and receive the coins.
+        count: The number of transactions.
+        seed: The seed of the random sender/recipient selection.
+    """
+    rng = Random(seed)
+    transactions = []
+    for number in range(count):
+        sender, recipient = rng.sample(wallets, 2) if len(wallets) > 1 else (wallets[0], wallets[0])
+        # The amount makes every transaction unique, so none of them is dropped as a duplicate
+        amount = round(0.01 + number * 0.0001, 4)
+        signature = sender.sign_transaction(sender.public_key, recipient.public_key, amount)
+        transactions.append(Transaction(sender.public_key, recipient.public_key, signature, amount))
+    return transactions
+
+
+def create_chain(wallets, blocks, transactions_per_block, seed=0):
+    """ Returns a valid chain (including the genesis block) of mined blocks with signed transactions.
+
+    Arguments:
+        wallets: The wallets which send, receive and mine the coins.
+        blocks: The number of blocks after the genesis block.
+        transactions_per_block: The number of signed transactions per block (besides the mining reward).
+        seed: The seed of the random sender/recipient selection.
+    """
+    miner = ProofOfWork(workers=1)
+    transactions = create_transactions(wallets, blocks * transactions_per_block, seed)
+    chain = [Block(0, '', [], 100, 0)]
+    for index in range(1, blocks + 1):
+        block_transactions = transactions[(index - 1) * transactions_per_block:index * transactions_per_block]
+        previous_hash = chain[-1].hash
+        reward = Transaction(Blockchain.MINING_REWARD_SENDER, wallets[index % len(wallets)].public_key, '',
+                             Blockchain.MINING_REWARD)
+        block_transactions = block_transactions + [reward]
+        proof = miner.mine_header(index, previous_hash, merkle_root(tx.digest for tx in block_transactions), float(index))
+        chain.append(Block(index, previous_hash, block_transactions, proof, float(index), Block.VERSION))
+    return chain
+
+
+def store_chain(node_id, chain, open_transactions=()):
+    """ Writes a chain and open transactions to the storage files of a node in the current directory. """
+    store = BlockStore(node_id)
+    store.rewrite(chain)
+    store.save_open_transactions(open_transactions)
+    store.save_peer_nodes([])
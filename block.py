@@ -1,13 +1,117 @@
+from json import dumps
 from time import time
 
+from transaction import Transaction
+from utility.hash_util import hash_string_256
+from utility.merkle import merkle_root
 from utility.printable import Printable
 
 
 class Block(Printable):
+    """ A block of the blockchain. Blocks are immutable, so their serialization and hash are computed only once.
 
-    def __init__(self, index, previous_hash, transactions, proof, timestamp=None):
-        self.index = index
-        self.previous_hash = previous_hash
-        self.transactions = transactions
-        self.proof = proof
-        self.timestamp = time() if timestamp is None else timestamp
+    The version decides how a block is hashed. Version 1 blocks are hashed with all their transactions. From
+    version 2 on, the header carries the Merkle root of the transactions instead, so the hash and the proof of
+    work cover a fixed-size header and a transaction can be proven to be part of a block by its Merkle path.
+    Blocks mined before keep version 1, so their hashes and the chains built on them stay valid.
+
+    Attributes:
+
+    - version: The version of the block format.
+    - index: The position of the block in the chain.
+    - previous_hash: The hash of the previous block.
+    - transactions: The transactions of the block; the last one is the mining reward.
+    - proof: The proof of work for the block.
+    - timestamp: The time the block was created.
+    """
+
+    # Blocks hashed with all their transactions
+    LEGACY_VERSION = 1
+    # The version of newly mined blocks
+    VERSION = 2
+
+    __slots__ = ('index', 'previous_hash', 'transactions', 'proof', 'timestamp', 'version', '_merkle_root', '_serialized', '_hash')
+
+    def __init__(self, index, previous_hash, transactions, proof, timestamp=None, version=LEGACY_VERSION):
+        object.__setattr__(self, 'index', index)
+        object.__setattr__(self, 'previous_hash', previous_hash)
+        object.__setattr__(self, 'transactions', tuple(transactions))
+        object.__setattr__(self, 'proof', proof)
+        object.__setattr__(self, 'timestamp', time() if timestamp is None else timestamp)
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, '_merkle_root', None)
+        object.__setattr__(self, '_serialized', None)
+        object.__setattr__(self, '_hash', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Blocks are immutable.')
+
+    def __delattr__(self, name):
+        raise AttributeError('Blocks are immutable.')
+
+    def __reduce__(self):
+        return Block, (self.index, self.previous_hash, self.transactions, self.proof, self.timestamp, self.version)
+
+    @staticmethod
+    def from_dict(block):
+        """ Rebuilds a block from the dict returned by to_dict, e.g. after it was sent as JSON. """
+        transactions = [Transaction.from_dict(tx) for tx in block['transactions']]
+        return Block(block['index'], block['previous_hash'], transactions, block['proof'], block['timestamp'],
+                     block.get('version', Block.LEGACY_VERSION))
+
+    def to_dict(self):
+        """ Returns a JSON serializable dict of the block, including the signatures of its transactions.
+
+        Version 1 blocks leave out the version, so their dicts stay the same as before.
+        """
+        block = {
+            'index': self.index,
+            'previous_hash': self.previous_hash,
+            'transactions': [tx.to_dict() for tx in self.transactions],
+            'proof': self.proof,
+            'timestamp': self.timestamp
+        }
+        if self.version != Block.LEGACY_VERSION:
+            block['version'] = self.version
+            block['merkle_root'] = self.merkle_root
+        return block
+
+    @property
+    def merkle_root(self):
+        """ The Merkle root over the digests of the transactions. """
+        if self._merkle_root is None:
+            object.__setattr__(self, '_merkle_root', merkle_root(tx.digest for tx in self.transactions))
+        return self._merkle_root
+
+    def header(self):
+        """ Returns the header of a block of version 2 or later, which its hash is computed from. """
+        return {
+            'version': self.version,
+            'index': self.index,
+            'previous_hash': self.previous_hash,
+            'merkle_root': self.merkle_root,
+            'proof': self.proof,
+            'timestamp': self.timestamp
+        }
+
+    def serialize(self):
+        """ Returns the canonical serialization of the block which its hash is computed from. """
+        if self._serialized is None:
+            if self.version == Block.LEGACY_VERSION:
+                hashable_block = {
+                    'index': self.index,
+                    'previous_hash': self.previous_hash,
+                    'transactions': [tx.to_ordered_dict() for tx in self.transactions],
+                    'proof': self.proof,
+                    'timestamp': self.timestamp
+                }
+            else:
+                hashable_block = self.header()
+            object.__setattr__(self, '_serialized', dumps(hashable_block, sort_keys=True))
+        return self._serialized
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            object.__setattr__(self, '_hash', hash_string_256(self.serialize().encode()))
+        return self._hash
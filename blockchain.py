@@ -1,32 +1,121 @@
-from functools import reduce
-from json import dumps, loads
-import pickle
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from time import time
 
 from block import Block
 from transaction import Transaction
+from utility import codec, metrics
+from utility.broadcast import Broadcaster
+from utility.gossip import Gossip
 from utility.hash_util import hash_block
+from utility.ledger import Ledger
+from utility.locks import ReadWriteLock
+from utility.mempool import Mempool
+from utility.merkle import merkle_path, merkle_root
+from utility.mining import ProofOfWork
+from utility.peers import PeerTable
+from utility.storage import BlockStore, StoredChain
+from utility.template import TemplateBuilder
+from utility.tx_index import TransactionIndex
 from utility.verification import Verification
 from wallet import Wallet
 
 
+class ChainSnapshot:
+    """ A read-only view of the chain as it was at one point in time.
+
+    Responses which read several values of the chain, e.g. the height and a page of blocks, use a snapshot,
+    so they stay consistent even if blocks are added or the chain is replaced meanwhile.
+
+    Attributes:
+
+    - height: The number of blocks in the chain.
+    """
+
+    def __init__(self, chain, height):
+        self.__chain = chain
+        self.height = height
+
+    @property
+    def tip(self):
+        """ The last block of the chain. """
+        return self.__chain[self.height - 1]
+
+    def block_at(self, index):
+        """ Returns the block at the given position of the chain (negative indices count from the tip). """
+        if index < 0:
+            index += self.height
+        if not 0 <= index < self.height:
+            raise IndexError('Block index out of range.')
+        return self.__chain[index]
+
+    def iter_blocks(self, start=0, stop=None):
+        """ Returns an iterator over the blocks in [start, stop).
+
+        Arguments:
+            start: The index of the first block (default = 0).
+            stop: The index after the last block (default = the height of the snapshot).
+        """
+        return self.__chain.iter_blocks(start, self.height if stop is None else min(stop, self.height))
+
+
 class Blockchain:
+    """ The chain, the open transactions and the peer nodes of a node.
+
+    The state is guarded by a reader/writer lock: lookups share the read lock, while every change is committed
+    under the write lock, one at a time. Expensive work which doesn't change the state, like checking signatures
+    and proofs or searching a proof of work, runs before the lock is taken. Broadcasts to peer nodes are sent
+    after it was released.
+
+    Blocks are mined with a template of the open transactions (see TemplateBuilder), which is built for the
+    next block in the background while a new block is broadcast.
+
+    Arguments:
+        public_key: The public key the mining rewards are sent to (None if the node has no wallet).
+        node_id: The id which the storage files of the node are named after.
+        hot_blocks: The number of blocks at the tip which are kept in memory; older blocks are read from disk.
+    """
 
     MINING_REWARD_SENDER = 'MINING REWARD'
     MINING_REWARD = 10
-
-    def __init__(self, public_key, node_id):
+    # Results of add_transactions for every transaction of a batch
+    TX_ACCEPTED = 'accepted'
+    TX_DUPLICATE = 'duplicate'
+    TX_CONFIRMED = 'confirmed'
+    TX_INVALID_DATA = 'invalid_data'
+    TX_INVALID_SIGNATURE = 'invalid_signature'
+    TX_INSUFFICIENT_FUNDS = 'insufficient_funds'
+    # A checkpoint of the balances is stored whenever the height reaches a multiple of this interval
+    CHECKPOINT_INTERVAL = 100
+    CHECKPOINT_VERSION = 2
+
+    def __init__(self, public_key, node_id, hot_blocks=StoredChain.HOT_BLOCKS):
         genesis_block = Block(0, '', [], 100, 0)
         self.__chain = [genesis_block]
-        self.__open_transactions = []
-        self.__peer_nodes = set()
+        self.__open_transactions = Mempool()
+        self.peers = PeerTable()
         self.public_key = public_key
         self.node_id = node_id
+        self.hot_blocks = hot_blocks
         self.resolve_conflicts = False
+        self.miner = ProofOfWork()
+        self.templates = TemplateBuilder()
+        self.__template = None
+        self.__prebuild = None
+        self.__prebuilder = ThreadPoolExecutor(max_workers=1, thread_name_prefix='template')
+        self.__ledger = Ledger()
+        self.__storage = BlockStore(node_id)
+        self.__tx_index = TransactionIndex(self.__storage.tx_index_path)
+        self.__broadcaster = Broadcaster(peers=self.peers)
+        self.gossip = Gossip(self.__broadcaster)
+        self.__lock = ReadWriteLock()
+        # Proof-of-work searches run outside of the lock and are cancelled through their events when the tip changes
+        self.__searches = set()
         self.load_data()
 
     @property
     def chain(self):
+        """ A copy of the whole chain. Prefer the read accessors below on hot paths, they don't copy. """
         return self.__chain[:]
 
     @chain.setter
@@ -35,76 +124,241 @@ class Blockchain:
 
     @property
     def open_transactions(self):
-        return self.__open_transactions[:]
+        return list(self.__open_transactions)
 
     @open_transactions.setter
     def open_transactions(self, val):
         pass
 
-    def load_data(self, use_pickle=False):
-        if use_pickle:
-            try:
-                with open('blockchain-{}.p'.format(self.node_id), mode='rb') as file:
-                    file_content = pickle.loads(file.read())
-                    self.__chain = file_content['chain']
-                    self.__open_transactions = file_content['ot']
-            except (IOError, IndexError):
-                print('File not found!')
+    # The chain is only ever appended to; replacing the chain binds a new StoredChain, and the blocks it removes
+    # are kept by the old one. A snapshot therefore only needs the chain and its length, it doesn't copy blocks.
+    # The accessors below read a single value; responses which read several values use a snapshot.
+
+    def snapshot(self):
+        """ Returns a consistent, read-only view of the chain as it is now. """
+        with self.__lock.read():
+            return ChainSnapshot(self.__chain, len(self.__chain))
+
+    @property
+    def tip(self):
+        """ The last block of the chain. """
+        return self.__chain[-1]
+
+    @property
+    def height(self):
+        """ The number of blocks in the chain. """
+        return len(self.__chain)
+
+    def block_at(self, index):
+        """ Returns the block at the given position of the chain (negative indices count from the tip). """
+        return self.__chain[index]
+
+    def iter_blocks(self, start=0, stop=None):
+        """ Returns an iterator over the blocks in [start, stop) as they were when the iterator was created.
+
+        Arguments:
+            start: The index of the first block (default = 0).
+            stop: The index after the last block (default = the current height).
+        """
+        return self.__chain.iter_blocks(start, stop)
+
+    @property
+    def mempool_size(self):
+        """ The number of open transactions. """
+        return len(self.__open_transactions)
+
+    @property
+    def mempool_version(self):
+        """ A number which changes whenever the open transactions change. """
+        return self.__open_transactions.version
+
+    def iter_open_transactions(self):
+        """ Returns an iterator over the open transactions in arrival order, without copying them. """
+        return iter(self.__open_transactions)
+
+    def find_transaction(self, tx_id):
+        """ Looks up a transaction by its id in the transaction index and the open transactions.
+
+        Arguments:
+            tx_id: The digest of the transaction.
+
+        :return: A (transaction, positions) tuple, where positions lists the (block index, transaction index)
+            tuples of the transaction and is empty if it is pending, or None if the transaction is unknown.
+        """
+        self.__tx_index.wait()
+        with self.__lock.read():
+            positions = self.__tx_index.locate(tx_id)
+            if positions:
+                block_index, number = positions[0]
+                return self.__chain[block_index].transactions[number], positions
+            transaction = self.__open_transactions.get(tx_id)
+            if transaction is not None:
+                return transaction, []
+            return None
+
+    def transaction_proofs(self, tx_id):
+        """ Returns the Merkle inclusion proofs of a confirmed transaction, one per block it is part of.
+
+        Version 1 blocks have no Merkle root, so transactions in them can't be proven and are left out.
+
+        Arguments:
+            tx_id: The digest of the transaction.
+
+        :return: A list of dicts with the header and hash of the block, the position of the transaction and its
+            Merkle path, or None if the transaction isn't confirmed.
+        """
+        self.__tx_index.wait()
+        with self.__lock.read():
+            found = [(self.__chain[block_index], number) for block_index, number in self.__tx_index.locate(tx_id)]
+        if not found:
+            return None
+        return [{
+            'block_hash': block.hash,
+            'header': block.header(),
+            'position': number,
+            'path': merkle_path([tx.digest for tx in block.transactions], number)
+        } for block, number in found if block.version != Block.LEGACY_VERSION]
+
+    def address_positions(self, address):
+        """ Returns a snapshot of the chain and the positions of all confirmed transactions of an address in it.
+
+        :return: A (snapshot, positions) tuple; the positions are (block index, transaction index) tuples in
+            chain order.
+        """
+        self.__tx_index.wait()
+        with self.__lock.read():
+            return ChainSnapshot(self.__chain, len(self.__chain)), list(self.__tx_index.address_positions(address))
+
+    def load_data(self):
+        with metrics.LOAD_DATA_SECONDS.time(), self.__lock.write():
+            self.__load_data()
+
+    def __load_data(self):
+        """ Opens the stored chain without reading its blocks and restores the balances from the checkpoint.
+
+        Only the tip and the blocks after the checkpoint are read, so starting a node doesn't depend on the
+        length of its chain. Without a usable checkpoint the balances are rebuilt from all blocks once.
+        """
+        if not self.__storage.exists() and not self.__storage.migrate_legacy():
+            print('File not found!')
+            self.__storage.rewrite(self.__chain)
         else:
-            try:
-                with open('blockchain-{}.txt'.format(self.node_id), mode='r') as file:
-                    file_content = file.readlines()
-                    blockchain = loads(file_content[0][:-1])
-                    updated_blockchain = []
-                    for block in blockchain:
-                        transactions = [Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in
-                                        block['transactions']]
-                        updated_block = Block(block['index'], block['previous_hash'], transactions, block['proof'],
-                                              block['timestamp'])
-                        updated_blockchain.append(updated_block)
-                    self.__chain = updated_blockchain
-                    open_transactions = loads(file_content[1][:-1])
-                    updated_open_transactions = []
-                    for tx in open_transactions:
-                        updated_transaction = Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount'])
-                        updated_open_transactions.append(updated_transaction)
-                    self.__open_transactions = updated_open_transactions
-                    self.__peer_nodes = set(loads(file_content[2]))
-            except (IOError, IndexError):
-                print('File not found!')
+            if not self.__storage.height:
+                self.__storage.rewrite(self.__chain)
+            self.__open_transactions = Mempool(self.__storage.load_open_transactions())
+            self.peers.restore(self.__storage.load_peer_nodes())
+        self.__chain = StoredChain(self.__storage, hot_blocks=self.hot_blocks)
+        # The transaction index is loaded from its side file in the background; lookups wait for it
+        self.__tx_index.open(self.__storage.generation, self.__chain)
+        if not self.__restore_checkpoint():
+            self.__ledger.rebuild(self.__chain, self.__open_transactions)
+            self.__save_checkpoint()
+
+    def __restore_checkpoint(self):
+        """ Restores the balances from the stored checkpoint and books the blocks appended after it.
+
+        :return: False if there is no checkpoint which matches the stored chain.
+        """
+        checkpoint = self.__storage.load_checkpoint()
+        if checkpoint is None or checkpoint.get('version') != Blockchain.CHECKPOINT_VERSION:
+            return False
+        if checkpoint.get('generation') != self.__storage.generation:
+            return False
+        height = checkpoint.get('height', 0)
+        if not 0 < height <= len(self.__chain) or hash_block(self.__chain[height - 1]) != checkpoint.get('tip_hash'):
+            return False
+        self.__ledger.restore(checkpoint['balances'], self.__open_transactions)
+        for block in self.__chain.iter_blocks(height):
+            self.__ledger.apply_block(block)
+        return True
+
+    def __save_checkpoint(self):
+        """ Stores the verified tip and the confirmed balances, so the next start doesn't replay the chain. """
+        self.__storage.save_checkpoint({
+            'version': Blockchain.CHECKPOINT_VERSION,
+            'generation': self.__storage.generation,
+            'height': len(self.__chain),
+            'tip_hash': hash_block(self.__chain[-1]),
+            'balances': self.__ledger.confirmed
+        })
+
+    def __checkpoint_if_due(self):
+        if len(self.__chain) % Blockchain.CHECKPOINT_INTERVAL == 0:
+            self.__save_checkpoint()
 
     def save_data(self):
-        with open('blockchain-{}.p'.format(self.node_id), mode='wb') as file:
-            data = {
-                'chain': self.__chain,
-                'ot': self.__open_transactions
-            }
-            file.write(pickle.dumps(data))
-        with open('blockchain-{}.txt'.format(self.node_id), mode='w') as file:
-            savable_chain = [
-                block.__dict__ for block in [
-                    Block(block_el.index, block_el.previous_hash, [
-                        tx.__dict__ for tx in block_el.transactions
-                    ], block_el.proof, block_el.timestamp) for block_el in self.__chain
-                ]
-            ]
-            file.write(dumps(savable_chain))
-            file.write('\n')
-            savable_open_transactions = [tx.__dict__ for tx in self.__open_transactions]
-            file.write(dumps(savable_open_transactions))
-            file.write('\n')
-            file.write(dumps(list(self.__peer_nodes)))
-
-    def proof_of_work(self):
-        last_block = self.__chain[-1]
-        last_hash = hash_block(last_block)
-        proof = 0
-        while not Verification.valid_proof(self.__open_transactions, last_hash, proof):
-            proof += 1
+        """ Rewrites all stored data in one go. Blocks are normally appended to the block log one by one. """
+        with self.__lock.write():
+            self.__storage.rewrite(self.__chain)
+            self.__tx_index.retag(self.__storage.generation)
+            self.__storage.save_open_transactions(self.__open_transactions)
+            self.__storage.save_peer_nodes(self.peers.to_list())
+            self.__save_checkpoint()
+
+    def proof_of_work(self, timestamp, transactions=None, last_hash=None, index=None, cancelled=None):
+        """ Searches a proof for the header of a block on the tip.
+
+        Arguments:
+            timestamp: The timestamp of the block, which the proof covers.
+            transactions: The transactions of the block including the reward transaction (default = the block
+                template and a reward for this node).
+            last_hash: The hash of the block it is mined on (default = the hash of the tip).
+            index: The index of the block (default = the height of the chain).
+            cancelled: A function which returns True once the search should be given up (optional).
+
+        :return: The proof or None if the search was cancelled.
+        """
+        if transactions is None:
+            transactions = self.block_template().transactions + [self.__reward_transaction()]
+        if last_hash is None:
+            last_hash = hash_block(self.__chain[-1])
+        if index is None:
+            index = len(self.__chain)
+        with metrics.PROOF_OF_WORK_SECONDS.time():
+            proof = self.miner.mine_header(index, last_hash, merkle_root(tx.digest for tx in transactions), timestamp, cancelled)
+        metrics.PROOF_OF_WORK_HASHES.inc(self.miner.attempts)
         return proof
 
+    def block_template(self):
+        """ Returns the template of the open transactions the next block on the tip is mined with.
+
+        The template is built once per tip and state of the open transactions and reused until either changes.
+        """
+        with self.__lock.read():
+            last_hash = hash_block(self.__chain[-1])
+            version = self.__open_transactions.version
+            template = self.__template
+            if template is not None and template.is_current(last_hash, version):
+                return template
+            open_transactions = self.__open_transactions
+        # The open transactions may be iterated while they change; transactions which are added meanwhile
+        # change the version, so the template is rebuilt the next time
+        reserved_bytes = len(codec.encode_transaction(self.__reward_transaction()))
+        template = self.templates.build(open_transactions, last_hash, version, reserved_bytes)
+        self.__template = template
+        return template
+
+    def __mark_seen(self, block):
+        """ Records the transactions of a block as seen by the gossip layer, so relayed copies which arrive after the block are dropped. """
+        for tx in block.transactions:
+            self.gossip.seen.add(tx.digest)
+
+    def __prebuild_template(self):
+        """ Builds the template for the next block in the background, unless the previous build is still running. """
+        if self.public_key is None or (self.__prebuild is not None and not self.__prebuild.done()):
+            return
+        self.__prebuild = self.__prebuilder.submit(self.block_template)
+
+    def __reward_transaction(self):
+        return Transaction(Blockchain.MINING_REWARD_SENDER, self.public_key, '', Blockchain.MINING_REWARD)
+
+    def __tip_changed(self):
+        """ Cancels all running proof-of-work searches, since their proofs would be for an outdated tip. """
+        for search in list(self.__searches):
+            search.set()
+
     def get_balance(self, sender=None):
-        """ Calculates the balance for a blockchain participant.
+        """ Looks up the balance for a blockchain participant in the ledger.
 
         :return: The current balance for the participant.
         """
@@ -115,12 +369,8 @@ class Blockchain:
         else:
             participant = sender
 
-        user_transactions = [[tx.amount * -1 for tx in block.transactions if tx.sender == participant] for block in self.__chain]
-        user_transactions.extend(
-            [[tx.amount for tx in block.transactions if tx.recipient == participant] for block in self.__chain])
-        user_transactions.append([tx.amount * -1 for tx in self.__open_transactions if tx.sender == participant])
-
-        return reduce(lambda tx_sum, tx_amt: tx_sum + sum(tx_amt) if len(tx_amt) > 0 else tx_sum, user_transactions, 0)
+        with self.__lock.read():
+            return self.__ledger.balance(participant)
 
     def get_last_blockchain_value(self):
         """ Returns the last value of the current blockchain. """
@@ -140,124 +390,316 @@ class Blockchain:
         #     return False
 
         transaction = Transaction(sender, recipient, signature, amount)
-        if Verification.verify_transaction(transaction, self.get_balance):
-            self.__open_transactions.append(transaction)
-            self.save_data()
-
-            if not is_receiving:
-                for node in self.__peer_nodes:
-                    url = 'http://{}/broadcast_transaction'.format(node)
-                    try:
-                        response = requests.post(url, json={'sender': sender, 'recipient': recipient, 'amount': amount, 'signature': signature})
-                        if response.status_code == 400 or response.status_code == 500:
-                            print('Transaction declined, needs resolving.')
-                            return False
-                    except requests.exceptions.ConnectionError:
-                        continue
-
-            return True
-        else:
+        if not Verification.valid_transaction_data(transaction):
+            print('Transaction data is invalid.')
+            return False
+        if transaction in self.__open_transactions:
+            print('Transaction is already pending.')
             return False
+        # Checking the signature is the expensive part, so it is done (and cached) before the lock is taken
+        if not Wallet.verify_transaction(transaction):
+            return False
+        # The index is checked for confirmed copies, so it has to be loaded; loading doesn't need the lock
+        self.__tx_index.wait()
+        with self.__lock.write():
+            if transaction in self.__open_transactions:
+                print('Transaction is already pending.')
+                return False
+            if self.__tx_index.locate(transaction.digest):
+                print('Transaction is already confirmed.')
+                return False
+            if not Verification.verify_transaction(transaction, self.get_balance):
+                return False
+            self.__open_transactions.add(transaction)
+            self.__ledger.add_pending(transaction)
+            self.__storage.save_open_transactions(self.__open_transactions)
+
+        if not is_receiving:
+            payload = {'sender': sender, 'recipient': recipient, 'amount': amount, 'signature': signature}
+            binary_payload = codec.encode_transactions([transaction])
+            for node, response in self.gossip.publish(self.get_peer_nodes(), transaction.digest, '/broadcast_transaction', payload, binary_payload):
+                if response is not None and (response.status_code == 400 or response.status_code == 500):
+                    print('Transaction declined, needs resolving.')
+                    return False
 
-    def mine_block(self):
-        if self.public_key is None:
-            return None
+        return True
 
-        hashed_block = hash_block(self.__chain[-1])
-        proof = self.proof_of_work()
+    def add_transactions(self, transactions, is_receiving=False):
+        """ Adds several transactions at once, e.g. from a payout job or a peer relaying a batch.
 
-        reward_transaction = Transaction(Blockchain.MINING_REWARD_SENDER, self.public_key, '', Blockchain.MINING_REWARD)
-        copied_transactions = self.__open_transactions[:]
+        All signatures are verified in one go. The transactions are checked in order, so the funds of a sender
+        are checked against the debits of its transactions earlier in the batch. The open transactions are
+        saved once and the accepted transactions are gossiped to the peer nodes in a single message.
 
-        for tx in copied_transactions:
-            if not Wallet.verify_transaction(tx):
-                return None
+        Arguments:
+            transactions: The transactions to add.
+            is_receiving: A boolean to determine whether or not this is an incoming request from another node.
+
+        :return: One of the TX_* results per transaction.
+        """
+        well_formed = [Verification.valid_transaction_data(tx) for tx in transactions]
+        signatures = iter(Wallet.verify_transactions([tx for tx, valid in zip(transactions, well_formed) if valid]))
+        results = []
+        accepted = []
+        self.__tx_index.wait()
+        with self.__lock.write():
+            for transaction, valid_data in zip(transactions, well_formed):
+                if not valid_data:
+                    results.append(Blockchain.TX_INVALID_DATA)
+                    continue
+                valid_signature = next(signatures)
+                if transaction in self.__open_transactions:
+                    results.append(Blockchain.TX_DUPLICATE)
+                elif self.__tx_index.locate(transaction.digest):
+                    results.append(Blockchain.TX_CONFIRMED)
+                elif not valid_signature:
+                    results.append(Blockchain.TX_INVALID_SIGNATURE)
+                elif self.get_balance(transaction.sender) < transaction.amount:
+                    results.append(Blockchain.TX_INSUFFICIENT_FUNDS)
+                else:
+                    self.__open_transactions.add(transaction)
+                    self.__ledger.add_pending(transaction)
+                    accepted.append(transaction)
+                    results.append(Blockchain.TX_ACCEPTED)
+            if accepted:
+                self.__storage.save_open_transactions(self.__open_transactions)
+
+        if accepted and not is_receiving:
+            payload = {'transactions': [tx.to_dict() for tx in accepted]}
+            binary_payload = codec.encode_transactions(accepted)
+            message_id = Gossip.message_id(tx.digest for tx in accepted)
+            for node, response in self.gossip.publish(self.get_peer_nodes(), message_id, '/broadcast_transactions/batch', payload, binary_payload):
+                if response is not None and (response.status_code == 400 or response.status_code == 500):
+                    print('Transactions declined by {}, needs resolving.'.format(node))
+        return results
+
+    def mine_block(self, cancelled=None):
+        """ Mines a block with the template of the open transactions on the current tip.
+
+        The search is given up as soon as the tip changes, e.g. because a block of a peer node was added.
+        Transactions which aren't part of the template or arrive during the search stay open for the next
+        block; transactions with an invalid signature are dropped.
 
-        copied_transactions.append(reward_transaction)
-        block = Block(len(self.__chain), hashed_block, copied_transactions, proof)
+        Arguments:
+            cancelled: A function which returns True once the search should be given up (optional).
 
-        self.__chain.append(block)
-        self.__open_transactions = []
-        self.save_data()
-        for node in self.__peer_nodes:
-            url = 'http://{}/broadcast-block'.format(node)
-            converted_block = block.__dict__.copy()
-            converted_block['transactions'] = [tx.__dict__ for tx in converted_block['transactions']]
-            try:
-                response = requests.post(url, json={'block': converted_block})
-                if response.status_code == 400 or response.status_code == 500:
-                    print('Block declined, needs resolving.')
-                if response.status_code == 409:
-                    self.resolve_conflicts = True
-            except requests.exceptions.ConnectionError:
+        :return: The new block or None if no block was mined.
+        """
+        if self.public_key is None:
+            return None
+
+        template = self.block_template()
+        hashed_block = template.last_hash
+        # If the chain grew meanwhile, the tip changed as well and the block is discarded below
+        index, timestamp = len(self.__chain), time()
+        copied_transactions = list(template.transactions)
+        # The header commits to the reward as well, so it is part of the block before the search starts
+        copied_transactions.append(self.__reward_transaction())
+
+        tip_changed = Event()
+        self.__searches.add(tip_changed)
+        try:
+            proof = self.proof_of_work(timestamp, copied_transactions, hashed_block, index,
+                                       lambda: tip_changed.is_set() or (cancelled is not None and cancelled()))
+        finally:
+            self.__searches.discard(tip_changed)
+        if proof is None:
+            return None
+
+        with self.__lock.write():
+            if hash_block(self.__chain[-1]) != hashed_block:
+                return None
+            block = Block(index, hashed_block, copied_transactions, proof, timestamp, Block.VERSION)
+
+            self.__chain.append(block)
+            self.__tip_changed()
+            Verification.mark_verified(hash_block(block))
+            self.__ledger.apply_block(block)
+            self.__tx_index.apply_block(block)
+            for tx in copied_transactions[:-1] + template.invalid:
+                confirmed_tx = self.__open_transactions.remove(tx)
+                if confirmed_tx is not None:
+                    self.__ledger.remove_pending(confirmed_tx)
+            self.__storage.append_block(block)
+            self.__storage.save_open_transactions(self.__open_transactions)
+            self.__checkpoint_if_due()
+        self.__mark_seen(block)
+        self.__prebuild_template()
+        payload, binary_payload = {'block': block.to_dict()}, codec.encode_block(block)
+        for node, response in self.gossip.publish(self.get_peer_nodes(), block.hash, '/broadcast-block', payload, binary_payload):
+            if response is None:
                 continue
+            if response.status_code == 400 or response.status_code == 500:
+                print('Block declined, needs resolving.')
+            if response.status_code == 409:
+                self.resolve_conflicts = True
+                metrics.CONFLICTS.inc()
 
         return block
 
     def add_block(self, block):
-        transactions = [Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in block['transactions']]
-        # Excluding the last transaction, because that is the "reward" transaction
-        valid_proof = Verification.valid_proof(transactions[:-1], block['previous_hash'], block['proof'])
-        hashes_match = hash_block(self.chain[-1]) == block['previous_hash']
-        if not valid_proof or not hashes_match:
+        """ Appends a block received from a peer node if it is valid and extends the local chain.
+
+        Arguments:
+            block: The received block.
+        """
+        if not Verification.valid_block_proof(block):
             return False
 
-        converted_block = Block(block['index'], block['previous_hash'], transactions, block['proof'], block['timestamp'])
-        self.__chain.append(converted_block)
-        stored_transactions = self.__open_transactions[:]
-        for itx in block['transactions']:
-            for opentx in stored_transactions:
-                if opentx.sender == itx['sender'] and opentx.recipient == itx['recipient'] and opentx.amount == itx['amount'] and opentx.signature == itx['signature']:
-                    try:
-                        self.__open_transactions.remove(opentx)
-                    except ValueError:
-                        print('Item was already removed')
-        self.save_data()
+        with self.__lock.write():
+            if not Verification.valid_successor(block, self.__chain[-1]):
+                return False
+
+            self.__chain.append(block)
+            self.__tip_changed()
+            Verification.mark_verified(hash_block(block))
+            self.__ledger.apply_block(block)
+            self.__tx_index.apply_block(block)
+            for tx in block.transactions:
+                confirmed_tx = self.__open_transactions.remove(tx)
+                if confirmed_tx is not None:
+                    self.__ledger.remove_pending(confirmed_tx)
+            self.__storage.append_block(block)
+            self.__storage.save_open_transactions(self.__open_transactions)
+            self.__checkpoint_if_due()
+        self.__mark_seen(block)
+        self.__prebuild_template()
         return True
 
+    def __fetch_blocks(self, node, start):
+        """ Downloads the blocks of a peer node from the given index on, or returns None if that failed. """
+        response = self.__broadcaster.get(node, '/chain', params={'from': start}, headers={'Accept': codec.CONTENT_TYPE})
+        if response is None or response.status_code != 200:
+            return None
+        try:
+            if codec.accepts_binary(response.headers.get('Content-Type')):
+                return codec.decode_chain(response.content)
+            return [Block.from_dict(block) for block in response.json()]
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    def __find_common_ancestor(self, node, peer_height):
+        """ Returns the index of the last block the local chain shares with a peer's chain (-1 if none, None on failure).
+
+        The peer's block hashes are compared from the local tip backwards in windows which double in size, so
+        a peer which just extends the local chain is settled with a single small request.
+        """
+        top = min(len(self.__chain), peer_height)
+        window = 16
+        while top > 0:
+            start = max(0, top - window)
+            response = self.__broadcaster.get(node, '/chain/hashes', params={'from': start, 'to': top})
+            if response is None or response.status_code != 200:
+                return None
+            try:
+                hashes = response.json()
+                for index in range(min(top, start + len(hashes)) - 1, start - 1, -1):
+                    if hashes[index - start] == hash_block(self.__chain[index]):
+                        return index
+            except (ValueError, KeyError, TypeError, IndexError):
+                return None
+            top = start
+            window *= 2
+        return -1
+
     def resolve(self):
-        winner_chain = self.chain
-        replace = False
+        """ Replaces the local chain with the longest valid chain of the peer nodes, if that is longer.
 
-        for node in self.__peer_nodes:
-            url = 'http://{}/chain'.format(node)
+        The heights of all reachable peers are fetched in parallel first. Starting with the highest peer (and
+        among equally high peers the fastest one), only the blocks after the last block it shares with the local
+        chain are downloaded and verified; the first peer whose chain turns out to be valid wins. The peer
+        stats which were gathered on the way are stored afterwards.
+        """
+        with metrics.RESOLVE_SECONDS.time():
+            replaced = self.__resolve()
+        with self.__lock.write():
+            self.__storage.save_peer_nodes(self.peers.to_list())
+        return replaced
+
+    def __resolve(self):
+        local_height = len(self.__chain)
+        candidates = {}
+        for node, response in self.__broadcaster.fetch(self.get_peer_nodes(), '/chain/head'):
+            if response is None or response.status_code != 200:
+                continue
             try:
-                response = requests.get(url)
-                node_chain = response.json()
-                node_chain = [Block(block['index'], block['previous_hash'], [Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in block['transactions']], block['proof'], block['timestamp']) for block in node_chain]
-                node_chain_length = len(node_chain)
-                local_chain_length = len(self.chain)
-                if node_chain_length > local_chain_length and Verification.verify_chain(node_chain):
-                    winner_chain = node_chain
-                    replace = True
-            except requests.exceptions.ConnectionError:
+                peer_height = response.json()['height']
+            except (ValueError, KeyError, TypeError, IndexError):
+                continue
+            if isinstance(peer_height, int):
+                self.peers.record_height(node, peer_height)
+                if peer_height > local_height:
+                    candidates[node] = peer_height
+
+        winner_chain, ancestor = None, None
+        for node in self.peers.rank(candidates):
+            peer_height = candidates[node]
+            ancestor = self.__find_common_ancestor(node, peer_height)
+            if ancestor is None:
+                continue
+            suffix = self.__fetch_blocks(node, ancestor + 1)
+            if not suffix or suffix[0].index != ancestor + 1:
                 continue
+            # The shared blocks were verified when they were added; the last one anchors the suffix
+            anchor = [self.__chain[ancestor]] if ancestor >= 0 else []
+            if ancestor + 1 + len(suffix) > local_height and Verification.verify_chain(anchor + suffix):
+                winner_chain = suffix
+                break
 
         self.resolve_conflicts = False
-        self.__chain = winner_chain
-        if replace:
-            self.__open_transactions = []
-        self.save_data()
-        return replace
+        if winner_chain is None:
+            return False
+
+        with self.__lock.write():
+            # The local chain may have grown while the peers were asked
+            if ancestor + 1 + len(winner_chain) <= len(self.__chain):
+                return False
+            if ancestor >= 0 and hash_block(self.__chain[ancestor]) != winner_chain[0].previous_hash:
+                return False
+            removed_blocks = list(self.__chain.iter_blocks(ancestor + 1))
+            # Snapshots of the old chain keep reading the removed blocks from memory once they are cut from the log
+            self.__chain.retain(ancestor + 1, removed_blocks)
+            for block in reversed(removed_blocks):
+                self.__ledger.revert_block(block)
+                self.__tx_index.revert_block(block)
+            for block in winner_chain:
+                self.__ledger.apply_block(block)
+                self.__tx_index.apply_block(block)
+            self.__open_transactions.clear()
+            self.__ledger.clear_pending()
+            self.__storage.truncate(ancestor + 1)
+            for block in winner_chain:
+                self.__storage.append_block(block)
+            self.__chain = StoredChain(self.__storage, hot_blocks=self.hot_blocks)
+            self.__tip_changed()
+            self.__storage.save_open_transactions(self.__open_transactions)
+            self.__save_checkpoint()
+        for block in winner_chain:
+            self.__mark_seen(block)
+        metrics.CHAIN_REPLACEMENTS.inc()
+        return True
 
     def add_peer_node(self, node):
-        """ Adds a new node to the peer node set.
+        """ Adds a new node to the peer table.
 
         Arguments:
             node: The node URL which should be added.
         """
-        self.__peer_nodes.add(node)
-        self.save_data()
+        with self.__lock.write():
+            self.peers.add(node)
+            self.__storage.save_peer_nodes(self.peers.to_list())
 
     def remove_peer_node(self, node):
-        """ Removes a new node to the peer node set.
+        """ Removes a node and its stats from the peer table.
 
         Arguments:
             node: The node URL which should be removed.
         """
-        self.__peer_nodes.discard(node)
-        self.save_data()
+        with self.__lock.write():
+            self.peers.remove(node)
+            self.__storage.save_peer_nodes(self.peers.to_list())
+        self.__broadcaster.forget(node)
 
     def get_peer_nodes(self):
         """ Return a list of all connected peer nodes. """
-        return list(self.__peer_nodes)
+        return self.peers.nodes()
@@ -1,12 +1,69 @@
-from flask import Flask, jsonify, request, send_from_directory
+from itertools import islice
+from json import dumps
+from uuid import uuid4
+
+from flask import Flask, Response, jsonify, request, send_from_directory
 from flask_cors import CORS
 
+from block import Block
 from blockchain import Blockchain
+from transaction import Transaction
+from utility import codec, metrics
+from utility.gossip import Gossip
+from utility.mining import BackgroundMiner
+from utility.storage import StoredChain
+from utility.template import TemplateBuilder
+from utility.verification import Verification
 from wallet import Wallet
 
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
 app = Flask(__name__)
-app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
-CORS(app)
+app.json.compact = True
+CORS(app, expose_headers=['ETag', 'X-Total-Count'])
+# The version of the open transactions starts over with every process, so their ETags carry an id of the process
+PROCESS_ID = uuid4().hex[:12]
+
+
+@app.after_request
+def announce_codec(response):
+    response.headers[codec.CODEC_HEADER] = codec.CONTENT_TYPE
+    return response
+
+
+def is_binary_request():
+    return request.mimetype == codec.CONTENT_TYPE
+
+
+def get_int_arg(*names, default=None):
+    """ Returns the first of the given query parameters which is set to an integer. """
+    for name in names:
+        value = request.args.get(name, type=int)
+        if value is not None:
+            return value
+    return default
+
+
+def get_page(total):
+    """ Returns the [start, stop) range selected by the offset (or from_index/from) and limit query parameters.
+
+    Arguments:
+        total: The number of items which can be paged through.
+    """
+    start = min(max(get_int_arg('offset', 'from_index', 'from', default=0), 0), total)
+    limit = get_int_arg('limit')
+    if limit is None:
+        return start, total
+    return start, min(start + max(limit, 0), total)
+
+
+def wants_ndjson():
+    return request.args.get('format') == 'ndjson' or NDJSON_CONTENT_TYPE in request.headers.get('Accept', '')
+
+
+def stream_ndjson(dicts):
+    """ Returns a chunked response with one JSON document per line, built while it is sent. """
+    return Response((dumps(item) + '\n' for item in dicts), mimetype=NDJSON_CONTENT_TYPE)
 
 
 @app.route('/', methods=['GET'])
@@ -23,8 +80,8 @@ def get_network_ui():
 def create_keys():
     wallet.create_keys()
     if wallet.save_keys():
-        global blockchain
-        blockchain = Blockchain(wallet.public_key, port)
+        # The loaded chain doesn't depend on the key, so only the key of the node is swapped
+        blockchain.public_key = wallet.public_key
 
         response = {
             'public_key': wallet.public_key,
@@ -42,8 +99,8 @@ def create_keys():
 @app.route('/wallet', methods=['GET'])
 def load_keys():
     if wallet.load_keys():
-        global blockchain
-        blockchain = Blockchain(wallet.public_key, port)
+        # The loaded chain doesn't depend on the key, so only the key of the node is swapped
+        blockchain.public_key = wallet.public_key
 
         response = {
             'public_key': wallet.public_key,
@@ -77,7 +134,13 @@ def get_balance():
 
 @app.route('/broadcast_transaction', methods=['POST'])
 def broadcast_transaction():
-    values = request.get_json()
+    if is_binary_request():
+        try:
+            values = codec.decode_transactions(request.get_data())[0].to_dict()
+        except (ValueError, IndexError):
+            values = None
+    else:
+        values = request.get_json()
     if not values:
         response = {
             'message': 'No data found.'
@@ -91,7 +154,19 @@ def broadcast_transaction():
         }
         return jsonify(response), 400
 
+    # Copies which reach the node on other paths are dropped before their signature is checked again
+    transaction = Transaction.from_dict(values)
+    if not Verification.valid_transaction_data(transaction):
+        response = {
+            'message': 'Transaction data is invalid.'
+        }
+        return jsonify(response), 400
+    if not blockchain.gossip.receive(transaction.digest, '/broadcast_transaction'):
+        return jsonify({'message': 'Transaction was seen before.'}), 200
+
     if blockchain.add_transaction(values['recipient'], values['sender'], values['signature'], values['amount'], is_receiving=True):
+        blockchain.gossip.relay(blockchain.get_peer_nodes(), transaction.digest, blockchain.gossip.get_ttl(request.headers),
+                                '/broadcast_transaction', transaction.to_dict(), codec.encode_transactions([transaction]))
         return jsonify({}), 201
     else:
         response = {
@@ -100,9 +175,83 @@ def broadcast_transaction():
         return jsonify(response), 500
 
 
+def add_transaction_batch(items, required_fields, to_transaction, ttl=None):
+    """ Adds a batch of transactions to the blockchain and returns the response with one result per item.
+
+    Batches relayed by peer nodes are dropped if they were seen before, and the accepted part is relayed on.
+
+    Arguments:
+        items: The transactions or dicts which were posted.
+        required_fields: The fields every dict has to contain.
+        to_transaction: A function which turns a complete dict into a transaction.
+        ttl: The TTL of a batch which was relayed by a peer node, None for a local batch.
+    """
+    is_receiving = ttl is not None
+    results = [None] * len(items)
+    transactions, positions = [], []
+    for position, item in enumerate(items):
+        if not isinstance(item, Transaction):
+            if not isinstance(item, dict) or not all(field in item for field in required_fields):
+                results[position] = 'missing_data'
+                continue
+            item = to_transaction(item)
+        if not Verification.valid_transaction_data(item):
+            results[position] = Blockchain.TX_INVALID_DATA
+            continue
+        transactions.append(item)
+        positions.append(position)
+    # The batch is only recorded as seen once its items parsed, so a corrected resend isn't dropped
+    path = '/broadcast_transactions/batch'
+    if is_receiving and transactions and not blockchain.gossip.receive(Gossip.message_id(tx.digest for tx in transactions), path):
+        return jsonify({'message': 'Transactions were seen before.'}), 200
+
+    outcomes = blockchain.add_transactions(transactions, is_receiving=is_receiving)
+    for position, result in zip(positions, outcomes):
+        results[position] = result
+    relayed = [tx for tx, result in zip(transactions, outcomes) if result == Blockchain.TX_ACCEPTED]
+    if is_receiving and relayed:
+        blockchain.gossip.relay(blockchain.get_peer_nodes(), Gossip.message_id(tx.digest for tx in relayed), ttl, path,
+                                {'transactions': [tx.to_dict() for tx in relayed]}, codec.encode_transactions(relayed))
+
+    accepted = results.count(Blockchain.TX_ACCEPTED)
+    response = {
+        'message': 'Added {} of {} transactions.'.format(accepted, len(items)),
+        'results': [{'index': position, 'result': result} for position, result in enumerate(results)]
+    }
+    if not is_receiving:
+        response['funds'] = blockchain.get_balance()
+    return jsonify(response), 201 if accepted else 400
+
+
+@app.route('/broadcast_transactions/batch', methods=['POST'])
+def broadcast_transactions_batch():
+    if is_binary_request():
+        try:
+            transactions = codec.decode_transactions(request.get_data())
+        except ValueError:
+            transactions = None
+    else:
+        values = request.get_json(silent=True)
+        transactions = values.get('transactions') if isinstance(values, dict) else None
+    if not transactions:
+        response = {
+            'message': 'No data found.'
+        }
+        return jsonify(response), 400
+
+    required_fields = ['sender', 'recipient', 'amount', 'signature']
+    return add_transaction_batch(transactions, required_fields, Transaction.from_dict, blockchain.gossip.get_ttl(request.headers))
+
+
 @app.route('/broadcast-block', methods=['POST'])
 def broadcast_block():
-    values = request.get_json()
+    if is_binary_request():
+        try:
+            values = {'block': codec.decode_block(request.get_data())}
+        except ValueError:
+            values = None
+    else:
+        values = request.get_json()
     if not values:
         response = {
             'message': 'No data found.'
@@ -115,17 +264,34 @@ def broadcast_block():
         return jsonify(response), 400
 
     block = values['block']
-    if block['index'] == blockchain.chain[-1].index + 1:
+    if not isinstance(block, Block):
+        try:
+            block = Block.from_dict(block)
+        except (KeyError, TypeError, ValueError):
+            block = None
+    if block is None or type(block.index) is not int:
+        response = {
+            'message': 'Required data is missing.'
+        }
+        return jsonify(response), 400
+    if not blockchain.gossip.receive(block.hash, '/broadcast-block'):
+        return jsonify({'message': 'Block was seen before.'}), 200
+
+    tip = blockchain.tip
+    if block.index == tip.index + 1:
         if blockchain.add_block(block):
+            blockchain.gossip.relay(blockchain.get_peer_nodes(), block.hash, blockchain.gossip.get_ttl(request.headers),
+                                    '/broadcast-block', {'block': block.to_dict()}, codec.encode_block(block))
             response = {'message': 'Block added'}
             return jsonify(response), 201
         else:
             response = {'message': 'Block seems invalid'}
             return jsonify(response), 409
 
-    elif block['index'] > blockchain.chain[-1].index + 1:
+    elif block.index > tip.index + 1:
         response = {'message': 'Blockchain seems to differ from local blockchain'}
         blockchain.resolve_conflicts = True
+        metrics.CONFLICTS.inc()
         return jsonify(response), 200
     else:
         response = {'message': 'Blockchain seems to be shorter, block not added'}
@@ -175,21 +341,148 @@ def add_transaction():
         return jsonify(response), 500
 
 
+@app.route('/transactions/batch', methods=['POST'])
+def add_transactions_batch():
+    if wallet.public_key is None:
+        response = {
+            'message': 'No wallet set up.'
+        }
+        return jsonify(response), 400
+
+    values = request.get_json(silent=True)
+    transactions = values.get('transactions') if isinstance(values, dict) else None
+    if not transactions:
+        response = {
+            'message': 'No data found.'
+        }
+        return jsonify(response), 400
+
+    def sign(values):
+        sender, recipient, amount = wallet.public_key, values['recipient'], values['amount']
+        return Transaction(sender, recipient, wallet.sign_transaction(sender, recipient, amount), amount)
+    return add_transaction_batch(transactions, ['recipient', 'amount'], sign)
+
+
 @app.route('/transactions', methods=['GET'])
 def get_open_transactions():
-    transactions = blockchain.open_transactions
-    dict_transactions = [tx.__dict__ for tx in transactions]
-    return jsonify(dict_transactions), 200
+    version = blockchain.mempool_version
+    total = blockchain.mempool_size
+    start, stop = get_page(total)
+    page = islice(blockchain.iter_open_transactions(), start, stop)
+    representation = 'ndjson' if wants_ndjson() else 'json'
+    etag = '{}-{}-{}-{}-{}'.format(PROCESS_ID, version, start, stop, representation)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif representation == 'ndjson':
+        response = stream_ndjson(tx.to_dict() for tx in page)
+    else:
+        response = jsonify([tx.to_dict() for tx in page])
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Total-Count'] = total
+    return response
 
 
 @app.route('/chain', methods=['GET'])
 def get_chain():
-    chain_snapshot = blockchain.chain
-    dict_chain = [block.__dict__.copy() for block in chain_snapshot]
-    for dict_block in dict_chain:
-        dict_block['transactions'] = [
-            tx.__dict__ for tx in dict_block['transactions']]
-    return jsonify(dict_chain), 200
+    snapshot = blockchain.snapshot()
+    height, tip = snapshot.height, snapshot.tip
+    start, stop = get_page(height)
+    page = snapshot.iter_blocks(start, stop)
+    if codec.accepts_binary(request.headers.get('Accept')):
+        representation = 'binary'
+    elif wants_ndjson():
+        representation = 'ndjson'
+    else:
+        representation = 'json'
+    # The tip hash covers the whole chain, so together with the page it identifies the response
+    etag = '{}-{}-{}-{}'.format(tip.hash, start, stop, representation)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif representation == 'binary':
+        response = Response(codec.encode_chain(page), mimetype=codec.CONTENT_TYPE)
+    elif representation == 'ndjson':
+        response = stream_ndjson(block.to_dict() for block in page)
+    else:
+        response = jsonify([block.to_dict() for block in page])
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Total-Count'] = height
+    return response
+
+
+@app.route('/chain/head', methods=['GET'])
+def get_chain_head():
+    snapshot = blockchain.snapshot()
+    response = {
+        'height': snapshot.height,
+        'tip_hash': snapshot.tip.hash
+    }
+    return jsonify(response), 200
+
+
+@app.route('/chain/hashes', methods=['GET'])
+def get_chain_hashes():
+    start = request.args.get('from', 0, type=int)
+    stop = request.args.get('to', type=int)
+    return jsonify([block.hash for block in blockchain.snapshot().iter_blocks(start, stop)]), 200
+
+
+@app.route('/tx/<tx_id>', methods=['GET'])
+def get_transaction(tx_id):
+    found = blockchain.find_transaction(tx_id)
+    if found is None:
+        response = {
+            'message': 'Transaction not found.'
+        }
+        return jsonify(response), 404
+
+    transaction, positions = found
+    response = {
+        'id': tx_id,
+        'transaction': transaction.to_dict(),
+        'confirmed': bool(positions),
+        'locations': [{'block_index': block_index, 'position': number} for block_index, number in positions]
+    }
+    return jsonify(response), 200
+
+
+@app.route('/tx/<tx_id>/proof', methods=['GET'])
+def get_transaction_proof(tx_id):
+    proofs = blockchain.transaction_proofs(tx_id)
+    if proofs is None:
+        response = {
+            'message': 'Transaction not found in a block.'
+        }
+        return jsonify(response), 404
+    if not proofs:
+        response = {
+            'message': 'Transaction is only part of version 1 blocks, which have no Merkle root.'
+        }
+        return jsonify(response), 409
+
+    response = {
+        'id': tx_id,
+        'proofs': proofs
+    }
+    return jsonify(response), 200
+
+
+@app.route('/address/<address>/transactions', methods=['GET'])
+def get_address_transactions(address):
+    snapshot, positions = blockchain.address_positions(address)
+    total = len(positions)
+    start, stop = get_page(total)
+    items = []
+    for block_index, number in positions[start:stop]:
+        transaction = snapshot.block_at(block_index).transactions[number]
+        items.append({'id': transaction.digest, 'block_index': block_index, 'position': number, 'transaction': transaction.to_dict()})
+    if wants_ndjson():
+        response = stream_ndjson(items)
+    else:
+        response = jsonify(items)
+    response.headers['X-Total-Count'] = total
+    return response, 200
 
 
 @app.route('/mine', methods=['POST'])
@@ -200,12 +493,12 @@ def mine():
 
     block = blockchain.mine_block()
     if block is not None:
-        dict_block = block.__dict__.copy()
-        dict_block['transactions'] = [tx.__dict__ for tx in dict_block['transactions']]
+        dict_block = block.to_dict()
         response = {
             'message': 'Block added successfully.',
             'block': dict_block,
-            'funds': blockchain.get_balance()
+            'funds': blockchain.get_balance(),
+            'hashrate': blockchain.miner.hashrate
         }
         return jsonify(response), 201
     else:
@@ -216,6 +509,39 @@ def mine():
         return jsonify(response), 500
 
 
+@app.route('/miner/start', methods=['POST'])
+def start_miner():
+    if wallet.public_key is None:
+        response = {
+            'message': 'No wallet set up.'
+        }
+        return jsonify(response), 400
+
+    values = request.get_json(silent=True) or {}
+    if 'mine_empty' in values:
+        miner.mine_empty = bool(values['mine_empty'])
+    if miner.start():
+        response = {'message': 'Miner started.', 'miner': miner.status()}
+        return jsonify(response), 201
+    else:
+        response = {'message': 'Miner is already running.', 'miner': miner.status()}
+        return jsonify(response), 200
+
+
+@app.route('/miner/stop', methods=['POST'])
+def stop_miner():
+    if miner.stop():
+        response = {'message': 'Miner stopped.', 'miner': miner.status()}
+    else:
+        response = {'message': 'Miner is not running.', 'miner': miner.status()}
+    return jsonify(response), 200
+
+
+@app.route('/miner/status', methods=['GET'])
+def get_miner_status():
+    return jsonify(miner.status()), 200
+
+
 @app.route('/resolve-conflicts', methods=['POST'])
 def resolve_conflicts():
     replaced = blockchain.resolve()
@@ -266,10 +592,16 @@ def remove_node(node_url):
     return jsonify(response), 200
 
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/nodes', methods=['GET'])
 def get_nodes():
     response = {
-        'all_nodes': blockchain.get_peer_nodes()
+        'all_nodes': blockchain.get_peer_nodes(),
+        'peers': blockchain.peers.to_list()
     }
     return jsonify(response), 200
 
@@ -278,10 +610,34 @@ if __name__ == '__main__':
     from argparse import ArgumentParser
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', type=int, default=5000)
+    parser.add_argument('--hot-blocks', type=int, default=StoredChain.HOT_BLOCKS,
+                        help='number of blocks at the tip which are kept in memory')
+    parser.add_argument('--difficulty', type=int, default=Verification.DIFFICULTY, help='proof-of-work difficulty')
+    parser.add_argument('--max-block-transactions', type=int, default=TemplateBuilder.MAX_TRANSACTIONS,
+                        help='maximum number of transactions a mined block takes from the open transactions')
+    parser.add_argument('--max-block-bytes', type=int, default=TemplateBuilder.MAX_BYTES,
+                        help='maximum encoded size of the transactions of a mined block')
+    parser.add_argument('--block-priority', choices=TemplateBuilder.PRIORITIES, default='arrival',
+                        help='order in which open transactions are taken into a mined block')
     args = parser.parse_args()
     port = args.port
+    Verification.DIFFICULTY = args.difficulty
 
     wallet = Wallet(port)
-    blockchain = Blockchain(wallet.public_key, port)
+    blockchain = Blockchain(wallet.public_key, port, args.hot_blocks)
+    blockchain.templates = TemplateBuilder(args.max_block_transactions, args.max_block_bytes, args.block_priority)
+    miner = BackgroundMiner(blockchain)
+
+    # The gauges look up the global blockchain when they are scraped, so they follow it if it is replaced
+    metrics.CHAIN_HEIGHT.set_function(lambda: blockchain.height)
+    metrics.MEMPOOL_SIZE.set_function(lambda: blockchain.mempool_size)
+    metrics.PEER_COUNT.set_function(lambda: len(blockchain.get_peer_nodes()))
+    metrics.HASHRATE.set_function(lambda: blockchain.miner.hashrate)
+    for metric, stat in ((metrics.KEY_CACHE_SIZE, 'key_cache_size'), (metrics.KEY_CACHE_LIMIT, 'key_cache_limit'),
+                         (metrics.KEY_CACHE_HITS, 'key_hits'), (metrics.KEY_CACHE_MISSES, 'key_misses'),
+                         (metrics.VERIFICATION_CACHE_SIZE, 'verification_cache_size'),
+                         (metrics.VERIFICATION_CACHE_LIMIT, 'verification_cache_limit'),
+                         (metrics.VERIFICATION_CACHE_MISSES, 'verification_misses')):
+        metric.set_function(lambda stat=stat: Wallet.cache_stats()[stat])
 
     app.run(host='0.0.0.0', port=port)
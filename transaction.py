@@ -1,10 +1,11 @@
 from collections import OrderedDict
 
+from utility.hash_util import hash_transaction
 from utility.printable import Printable
 
 
 class Transaction(Printable):
-    """ A transaction which can be added to a block in the blockchain.
+    """ A transaction which can be added to a block in the blockchain. Transactions are immutable.
 
     Attributes:
 
@@ -14,11 +15,43 @@ class Transaction(Printable):
     - amount: The number of coins sent.
     """
 
+    __slots__ = ('sender', 'recipient', 'signature', 'amount', '_ordered_dict', '_digest')
+
     def __init__(self, sender, recipient, signature, amount):
-        self.sender = sender
-        self.recipient = recipient
-        self.signature = signature
-        self.amount = amount
+        object.__setattr__(self, 'sender', sender)
+        object.__setattr__(self, 'recipient', recipient)
+        object.__setattr__(self, 'signature', signature)
+        object.__setattr__(self, 'amount', amount)
+        object.__setattr__(self, '_ordered_dict', None)
+        object.__setattr__(self, '_digest', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Transactions are immutable.')
+
+    def __delattr__(self, name):
+        raise AttributeError('Transactions are immutable.')
+
+    def __reduce__(self):
+        return Transaction, (self.sender, self.recipient, self.signature, self.amount)
+
+    @staticmethod
+    def from_dict(transaction):
+        """ Rebuilds a transaction from the dict returned by to_dict, e.g. after it was sent as JSON. """
+        return Transaction(transaction['sender'], transaction['recipient'], transaction['signature'], transaction['amount'])
+
+    def to_dict(self):
+        """ Returns a JSON serializable dict of the transaction, including its signature. """
+        return {'sender': self.sender, 'recipient': self.recipient, 'signature': self.signature, 'amount': self.amount}
 
     def to_ordered_dict(self):
-        return OrderedDict([('sender', self.sender), ('recipient', self.recipient), ('amount', self.amount)])
+        """ Returns the signed part of the transaction. The dict is shared, so it must not be modified. """
+        if self._ordered_dict is None:
+            object.__setattr__(self, '_ordered_dict', OrderedDict([('sender', self.sender), ('recipient', self.recipient), ('amount', self.amount)]))
+        return self._ordered_dict
+
+    @property
+    def digest(self):
+        """ The hash of the transaction including its signature, which identifies the transaction. """
+        if self._digest is None:
+            object.__setattr__(self, '_digest', hash_transaction(self))
+        return self._digest
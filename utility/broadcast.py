@@ -0,0 +1,138 @@
+""" Provides pooled, concurrent HTTP requests to peer nodes. """
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utility import codec, metrics
+
+
+class Broadcaster:
+    """ Sends requests to peer nodes over one keep-alive session per peer.
+
+    Broadcasts are fanned out over a bounded thread pool, so the time a broadcast takes depends on the slowest
+    peer instead of the sum of all peers. Every request has a timeout; a peer which can't be reached or doesn't
+    answer in time is reported with a None response.
+
+    Peers which announce the binary encoding through the codec response header are sent binary payloads once
+    they answered a request; all other peers get JSON.
+
+    With a peer table, every answer and failure is recorded in it. The connect timeout then adapts to the
+    latency of the peer, so a dead peer fails fast, and broadcasts skip peers which are backing off after
+    failures.
+
+    Attributes:
+
+    - timeout: The number of seconds to wait for a peer to connect and to answer.
+    - max_workers: The maximum number of requests which are sent at the same time.
+    - peers: The PeerTable which tracks the health of the peers (optional).
+    """
+
+    TIMEOUT = 5
+    MAX_WORKERS = 8
+
+    def __init__(self, timeout=TIMEOUT, max_workers=MAX_WORKERS, peers=None):
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.peers = peers
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='broadcast')
+        self.__sessions = {}
+        self.__binary_peers = set()
+        self.__lock = Lock()
+
+    def session(self, node):
+        """ Returns the session for a peer node, creating it on first use.
+
+        Arguments:
+            node: The node URL (host:port) of the peer.
+        """
+        with self.__lock:
+            session = self.__sessions.get(node)
+            if session is None:
+                session = requests.Session()
+                session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers))
+                self.__sessions[node] = session
+            return session
+
+    def forget(self, node):
+        """ Closes the session of a peer node which was removed. """
+        with self.__lock:
+            session = self.__sessions.pop(node, None)
+            self.__binary_peers.discard(node)
+        if session is not None:
+            session.close()
+
+    def request(self, node, method, path, **kwargs):
+        """ Sends a single request to a peer node.
+
+        Arguments:
+            node: The node URL (host:port) of the peer.
+            method: The HTTP method, e.g. 'GET' or 'POST'.
+            path: The route on the peer, e.g. '/chain'.
+            kwargs: Further arguments for requests, e.g. json or params.
+
+        :return: The response or None if the peer couldn't be reached in time.
+        """
+        url = 'http://{}{}'.format(node, path)
+        timeout = self.timeout if self.peers is None else (self.peers.timeout(node, self.timeout), self.timeout)
+        try:
+            with metrics.PEER_REQUEST_SECONDS.time(peer=node, path=path):
+                response = self.session(node).request(method, url, timeout=timeout, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            metrics.PEER_REQUEST_FAILURES.inc(peer=node, path=path)
+            if self.peers is not None:
+                backoff = self.peers.record_failure(node)
+                print('Peer {} can not be reached, trying again in {:.0f} seconds.'.format(node, backoff))
+            return None
+        if self.peers is not None:
+            self.peers.record_success(node, response.elapsed.total_seconds())
+        if codec.accepts_binary(response.headers.get(codec.CODEC_HEADER)):
+            with self.__lock:
+                self.__binary_peers.add(node)
+        return response
+
+    def accepts_binary(self, node):
+        """ Returns whether the peer node announced that it accepts the binary encoding. """
+        return node in self.__binary_peers
+
+    def get(self, node, path, **kwargs):
+        return self.request(node, 'GET', path, **kwargs)
+
+    def post(self, node, path, **kwargs):
+        return self.request(node, 'POST', path, **kwargs)
+
+    def reachable(self, nodes):
+        """ Returns the given peer nodes which aren't backing off after failures. """
+        return list(nodes) if self.peers is None else self.peers.reachable(nodes)
+
+    def fetch(self, nodes, path, **kwargs):
+        """ Sends the same GET request to all given peer nodes in parallel, skipping peers which are backing off.
+
+        :return: A list of (node, response) tuples; the response is None for peers which couldn't be reached.
+        """
+        nodes = self.reachable(nodes)
+        futures = [self.__executor.submit(self.get, node, path, **kwargs) for node in nodes]
+        return [(node, future.result()) for node, future in zip(nodes, futures)]
+
+    def __send(self, node, path, payload, binary_payload, headers):
+        if binary_payload is not None and self.accepts_binary(node):
+            return self.post(node, path, data=binary_payload, headers=dict(headers or {}, **{'Content-Type': codec.CONTENT_TYPE}))
+        return self.post(node, path, json=payload, headers=headers)
+
+    def broadcast(self, nodes, path, payload, binary_payload=None, headers=None):
+        """ Posts the same payload to all given peer nodes in parallel, skipping peers which are backing off.
+
+        Arguments:
+            nodes: The node URLs of the peers.
+            path: The route on the peers, e.g. '/broadcast-block'.
+            payload: The JSON payload.
+            binary_payload: The binary encoding of the payload for peers which accept it (optional).
+            headers: Further request headers (optional).
+
+        :return: A list of (node, response) tuples; the response is None for peers which couldn't be reached.
+        """
+        nodes = self.reachable(nodes)
+        futures = [self.__executor.submit(self.__send, node, path, payload, binary_payload, headers) for node in nodes]
+        return [(node, future.result()) for node, future in zip(nodes, futures)]
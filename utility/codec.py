@@ -0,0 +1,149 @@
+""" Provides a compact, versioned binary encoding for blocks and transactions.
+
+Keys, signatures and hashes are hex strings in JSON; the binary encoding stores them as raw bytes, which halves
+their size. Every value is written with a one byte type tag, so decoding yields exactly the values which were
+encoded (an int stays an int, a float stays a float) and block hashes don't change.
+"""
+
+from json import dumps, loads
+import re
+import struct
+
+from block import Block
+from transaction import Transaction
+
+CONTENT_TYPE = 'application/x-smotcoin'
+# Response header through which a node tells its peers that it accepts the binary encoding
+CODEC_HEADER = 'X-Smotcoin-Codec'
+VERSION = 1
+# Block records start with the version of the block; version 1 records are the ones written before blocks had versions
+BLOCK_VERSIONS = (Block.LEGACY_VERSION, Block.VERSION)
+
+LENGTH = struct.Struct('>I')
+INT = struct.Struct('>q')
+FLOAT = struct.Struct('>d')
+
+TAG_INT = b'i'
+TAG_FLOAT = b'f'
+TAG_HEX = b'h'
+TAG_STRING = b's'
+TAG_JSON = b'j'
+
+HEX_PATTERN = re.compile('(?:[0-9a-f]{2})*')
+
+
+def accepts_binary(mimetypes):
+    """ Returns whether the binary encoding is among the given accepted or sent mimetypes. """
+    return CONTENT_TYPE in (mimetypes or '')
+
+
+def _encode_value(value):
+    if type(value) is int and -2 ** 63 <= value < 2 ** 63:
+        return TAG_INT + INT.pack(value)
+    if type(value) is float:
+        return TAG_FLOAT + FLOAT.pack(value)
+    if type(value) is str:
+        if HEX_PATTERN.fullmatch(value):
+            raw = bytes.fromhex(value)
+            return TAG_HEX + LENGTH.pack(len(raw)) + raw
+        raw = value.encode()
+        return TAG_STRING + LENGTH.pack(len(raw)) + raw
+    raw = dumps(value).encode()
+    return TAG_JSON + LENGTH.pack(len(raw)) + raw
+
+
+class _Reader:
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def read(self, size):
+        if self.offset + size > len(self.data):
+            raise ValueError('Truncated binary payload.')
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return chunk
+
+    def length(self):
+        return LENGTH.unpack(self.read(LENGTH.size))[0]
+
+    def version(self):
+        version = self.read(1)[0]
+        if version != VERSION:
+            raise ValueError('Unsupported binary payload version {}.'.format(version))
+
+    def value(self):
+        tag = bytes(self.read(1))
+        if tag == TAG_INT:
+            return INT.unpack(self.read(INT.size))[0]
+        if tag == TAG_FLOAT:
+            return FLOAT.unpack(self.read(FLOAT.size))[0]
+        if tag == TAG_HEX:
+            return self.read(self.length()).hex()
+        if tag == TAG_STRING:
+            return str(self.read(self.length()), 'utf8')
+        if tag == TAG_JSON:
+            return loads(str(self.read(self.length()), 'utf8'))
+        raise ValueError('Unknown value tag {!r}.'.format(tag))
+
+    def transaction(self):
+        return Transaction(self.value(), self.value(), self.value(), self.value())
+
+    def block(self):
+        # The version byte of a block is the version of the block itself
+        version = self.read(1)[0]
+        if version not in BLOCK_VERSIONS:
+            raise ValueError('Unsupported block version {}.'.format(version))
+        index, previous_hash, proof, timestamp = self.value(), self.value(), self.value(), self.value()
+        transactions = [self.transaction() for _ in range(self.length())]
+        return Block(index, previous_hash, transactions, proof, timestamp, version)
+
+
+def encode_transaction(transaction):
+    """ Returns the binary encoding of a single transaction, as it is stored inside a block. """
+    return b''.join(_encode_value(value) for value in
+                    (transaction.sender, transaction.recipient, transaction.signature, transaction.amount))
+
+
+def encode_block(block):
+    """ Returns the binary encoding of a block. """
+    return b''.join([
+        bytes([block.version]),
+        _encode_value(block.index),
+        _encode_value(block.previous_hash),
+        _encode_value(block.proof),
+        _encode_value(block.timestamp),
+        LENGTH.pack(len(block.transactions))
+    ] + [encode_transaction(tx) for tx in block.transactions])
+
+
+def decode_block(data):
+    """ Rebuilds a block from its binary encoding. Raises ValueError for malformed data. """
+    return _Reader(data).block()
+
+
+def encode_chain(blocks):
+    """ Returns the binary encoding of a list of blocks. """
+    blocks = list(blocks)
+    return bytes([VERSION]) + LENGTH.pack(len(blocks)) + b''.join(encode_block(block) for block in blocks)
+
+
+def decode_chain(data):
+    """ Rebuilds a list of blocks from its binary encoding. Raises ValueError for malformed data. """
+    reader = _Reader(data)
+    reader.version()
+    return [reader.block() for _ in range(reader.length())]
+
+
+def encode_transactions(transactions):
+    """ Returns the binary encoding of a list of transactions. """
+    transactions = list(transactions)
+    return bytes([VERSION]) + LENGTH.pack(len(transactions)) + b''.join(encode_transaction(tx) for tx in transactions)
+
+
+def decode_transactions(data):
+    """ Rebuilds a list of transactions from its binary encoding. Raises ValueError for malformed data. """
+    reader = _Reader(data)
+    reader.version()
+    return [reader.transaction() for _ in range(reader.length())]
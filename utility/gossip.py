@@ -0,0 +1,140 @@
+""" Provides the gossip layer which spreads transactions and blocks through the network. """
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from random import Random
+from threading import Lock
+
+from utility import metrics
+from utility.hash_util import hash_string_256
+
+# Request header which carries the number of hops a message may still travel
+TTL_HEADER = 'X-Smotcoin-TTL'
+
+
+class SeenCache:
+    """ Remembers the ids of the most recently seen messages, forgetting the oldest ones beyond its size. """
+
+    def __init__(self, size):
+        self.size = size
+        self.__ids = OrderedDict()
+        self.__lock = Lock()
+
+    def __len__(self):
+        return len(self.__ids)
+
+    def __contains__(self, message_id):
+        return message_id in self.__ids
+
+    def add(self, message_id):
+        """ Records a message id.
+
+        :return: True if the id wasn't seen before.
+        """
+        with self.__lock:
+            if message_id in self.__ids:
+                self.__ids.move_to_end(message_id)
+                return False
+            self.__ids[message_id] = True
+            if len(self.__ids) > self.size:
+                self.__ids.popitem(last=False)
+            return True
+
+
+class Gossip:
+    """ Spreads messages by sending them to a few random peers, which relay them in turn until their TTL is used up.
+
+    A message is identified by the hash of its content (see message_id), so a node drops copies which reach it
+    on other paths before it verifies them again. The TTL travels in a request header, which works for JSON and
+    binary payloads alike; messages of nodes which don't send it get the full TTL.
+
+    Attributes:
+
+    - fanout: The number of peers a message is sent to at every hop.
+    - ttl: The number of hops a message published by this node travels.
+    """
+
+    FANOUT = 4
+    TTL = 6
+    SEEN_CACHE_SIZE = 100000
+    RELAY_WORKERS = 2
+
+    def __init__(self, broadcaster, fanout=FANOUT, ttl=TTL, seen_cache_size=SEEN_CACHE_SIZE):
+        self.broadcaster = broadcaster
+        self.fanout = fanout
+        self.ttl = ttl
+        self.seen = SeenCache(seen_cache_size)
+        self.__random = Random()
+        # Relays have their own pool, since they wait for broadcasts which run on the pool of the broadcaster
+        self.__relays = ThreadPoolExecutor(max_workers=Gossip.RELAY_WORKERS, thread_name_prefix='gossip')
+
+    @staticmethod
+    def message_id(digests):
+        """ Returns the id of a message carrying the items with the given digests (transaction digests or block hashes). """
+        digests = list(digests)
+        if len(digests) == 1:
+            return digests[0]
+        return hash_string_256(''.join(digests).encode())
+
+    def get_ttl(self, headers):
+        """ Returns the TTL of a received message from the request headers. """
+        try:
+            return int(headers[TTL_HEADER])
+        except (KeyError, ValueError):
+            return self.ttl
+
+    def select(self, nodes):
+        """ Returns the random subset of the given peer nodes a message is sent to, leaving out peers which are backing off. """
+        nodes = self.broadcaster.reachable(nodes)
+        if len(nodes) <= self.fanout:
+            return nodes
+        return self.__random.sample(nodes, self.fanout)
+
+    def receive(self, message_id, path):
+        """ Records a message received from a peer.
+
+        :return: False if the message was seen before and should be dropped.
+        """
+        new = self.seen.add(message_id)
+        metrics.GOSSIP_MESSAGES.inc(path=path, outcome='received' if new else 'duplicate')
+        return new
+
+    def publish(self, nodes, message_id, path, payload, binary_payload=None):
+        """ Sends a message which originates at this node to a random subset of the peer nodes.
+
+        Arguments:
+            nodes: The node URLs of the peers.
+            message_id: The id of the message.
+            path: The route on the peers, e.g. '/broadcast-block'.
+            payload: The JSON payload.
+            binary_payload: The binary encoding of the payload for peers which accept it (optional).
+
+        :return: A list of (node, response) tuples; the response is None for peers which couldn't be reached.
+        """
+        self.seen.add(message_id)
+        metrics.GOSSIP_MESSAGES.inc(path=path, outcome='published')
+        return self.__send(nodes, self.ttl, path, payload, binary_payload)
+
+    def relay(self, nodes, message_id, ttl, path, payload, binary_payload=None):
+        """ Forwards a received message in the background, unless its TTL is used up.
+
+        Arguments:
+            nodes: The node URLs of the peers.
+            message_id: The id of the forwarded message, which may differ from the received one if only a part
+                of it is forwarded.
+            ttl: The TTL the message was received with.
+            path: The route on the peers.
+            payload: The JSON payload.
+            binary_payload: The binary encoding of the payload for peers which accept it (optional).
+
+        :return: True if the message is relayed.
+        """
+        self.seen.add(message_id)
+        if ttl <= 1:
+            return False
+        metrics.GOSSIP_MESSAGES.inc(path=path, outcome='relayed')
+        self.__relays.submit(self.__send, list(nodes), ttl - 1, path, payload, binary_payload)
+        return True
+
+    def __send(self, nodes, ttl, path, payload, binary_payload):
+        return self.broadcaster.broadcast(self.select(nodes), path, payload, binary_payload, headers={TTL_HEADER: str(ttl)})
@@ -12,11 +12,18 @@ def hash_string_256(string):
 
 
 def hash_block(block):
-    """ Hashes a block and returns a string representation of it.
+    """ Hashes a block and returns a string representation of it. The hash is computed once per block.
 
     Arguments:
         block: The block that should be hashed.
     """
-    hashable_block = block.__dict__.copy()
-    hashable_block['transactions'] = [tx.to_ordered_dict() for tx in block.transactions]
-    return hash_string_256(dumps(hashable_block, sort_keys=True).encode())
+    return block.hash
+
+
+def hash_transaction(transaction):
+    """ Hashes a transaction including its signature and returns the hexdigest, which identifies the transaction.
+
+    Arguments:
+        transaction: The transaction that should be hashed.
+    """
+    return hash_string_256(dumps(transaction.to_dict(), sort_keys=True).encode())
@@ -0,0 +1,84 @@
+""" Provides an incrementally maintained balance index. """
+
+
+class Ledger:
+    """ Keeps the balance of every blockchain participant so lookups don't need to scan the chain.
+
+    Confirmed balances are derived from the blocks applied to the ledger; pending debits are derived from the
+    open transactions. The balance of a participant is the confirmed balance minus its pending debits.
+    """
+
+    def __init__(self):
+        self.__confirmed = {}
+        self.__pending = {}
+
+    def rebuild(self, chain, open_transactions):
+        """ Discards the current state and recomputes it from scratch.
+
+        Arguments:
+            chain: The blocks which should be reflected in the confirmed balances.
+            open_transactions: The transactions which should be reflected in the pending debits.
+        """
+        self.__confirmed = {}
+        self.__pending = {}
+        for block in chain:
+            self.apply_block(block)
+        for tx in open_transactions:
+            self.add_pending(tx)
+
+    def restore(self, confirmed, open_transactions):
+        """ Replaces the current state with confirmed balances taken from a checkpoint.
+
+        Arguments:
+            confirmed: The confirmed balances as returned by the confirmed property.
+            open_transactions: The transactions which should be reflected in the pending debits.
+        """
+        self.__confirmed = dict(confirmed)
+        self.__pending = {}
+        for tx in open_transactions:
+            self.add_pending(tx)
+
+    @property
+    def confirmed(self):
+        """ A copy of the confirmed balances, e.g. to store them in a checkpoint. """
+        return dict(self.__confirmed)
+
+    def apply_block(self, block):
+        """ Books all transactions of a newly appended block.
+
+        Arguments:
+            block: The block which was appended to the chain.
+        """
+        for tx in block.transactions:
+            self.__confirmed[tx.sender] = self.__confirmed.get(tx.sender, 0) - tx.amount
+            self.__confirmed[tx.recipient] = self.__confirmed.get(tx.recipient, 0) + tx.amount
+
+    def revert_block(self, block):
+        """ Undoes apply_block for a block which was removed from the chain. """
+        for tx in block.transactions:
+            self.__confirmed[tx.sender] = self.__confirmed.get(tx.sender, 0) + tx.amount
+            self.__confirmed[tx.recipient] = self.__confirmed.get(tx.recipient, 0) - tx.amount
+
+    def add_pending(self, transaction):
+        """ Books the debit of a transaction which was added to the open transactions. """
+        self.__pending[transaction.sender] = self.__pending.get(transaction.sender, 0) + transaction.amount
+
+    def remove_pending(self, transaction):
+        """ Releases the debit of a transaction which left the open transactions. """
+        remaining = self.__pending.get(transaction.sender, 0) - transaction.amount
+        if remaining:
+            self.__pending[transaction.sender] = remaining
+        else:
+            self.__pending.pop(transaction.sender, None)
+
+    def clear_pending(self):
+        """ Releases all pending debits, e.g. after the open transactions were mined. """
+        self.__pending = {}
+
+    def balance(self, participant):
+        """ Returns the confirmed balance of a participant minus its pending debits.
+
+        Arguments:
+            participant: The public key of the participant.
+        """
+        return self.__confirmed.get(participant, 0) - self.__pending.get(participant, 0)
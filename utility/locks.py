@@ -0,0 +1,88 @@
+""" Provides the reader/writer lock which guards the state of a node. """
+
+from contextlib import contextmanager
+from threading import Condition, Lock, get_ident, local
+
+from utility import metrics
+
+
+class ReadWriteLock:
+    """ Lets any number of readers hold the lock at the same time, or a single writer.
+
+    Writers are preferred: once a writer waits, new readers wait until it is done, so a steady stream of
+    reads can't starve the writers. Both modes are reentrant, and the writer may also take the read lock.
+    A reader can't upgrade to the write lock, since two readers doing so would wait for each other forever.
+
+    Arguments:
+        name: The label under which the time spent waiting for the lock is recorded.
+    """
+
+    def __init__(self, name='blockchain'):
+        self.name = name
+        self.__condition = Condition(Lock())
+        self.__readers = 0
+        self.__writer = None
+        self.__writer_depth = 0
+        self.__waiting_writers = 0
+        self.__local = local()
+
+    def acquire_read(self):
+        reads = getattr(self.__local, 'reads', 0)
+        with metrics.LOCK_WAIT_SECONDS.time(lock=self.name, mode='read'):
+            with self.__condition:
+                # Nested reads must not wait for a waiting writer, which waits for this reader in turn
+                if not reads and self.__writer != get_ident():
+                    while self.__writer is not None or self.__waiting_writers:
+                        self.__condition.wait()
+                self.__readers += 1
+        self.__local.reads = reads + 1
+
+    def release_read(self):
+        with self.__condition:
+            self.__readers -= 1
+            if not self.__readers:
+                self.__condition.notify_all()
+        self.__local.reads -= 1
+
+    def acquire_write(self):
+        me = get_ident()
+        with metrics.LOCK_WAIT_SECONDS.time(lock=self.name, mode='write'):
+            with self.__condition:
+                if self.__writer == me:
+                    self.__writer_depth += 1
+                    return
+                if getattr(self.__local, 'reads', 0):
+                    raise RuntimeError('A read lock can not be upgraded to a write lock.')
+                self.__waiting_writers += 1
+                try:
+                    while self.__writer is not None or self.__readers:
+                        self.__condition.wait()
+                finally:
+                    self.__waiting_writers -= 1
+                self.__writer = me
+                self.__writer_depth = 1
+
+    def release_write(self):
+        with self.__condition:
+            self.__writer_depth -= 1
+            if not self.__writer_depth:
+                self.__writer = None
+                self.__condition.notify_all()
+
+    @contextmanager
+    def read(self):
+        """ Returns a context manager which holds the read lock while it is entered. """
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        """ Returns a context manager which holds the write lock while it is entered. """
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
@@ -0,0 +1,80 @@
+""" Provides the pool of open transactions. """
+
+
+class Mempool:
+    """ Holds the open transactions keyed by their digest, in the order in which they arrived.
+
+    Adding, looking up and removing a transaction are constant-time operations; iterating yields the
+    transactions in arrival order, which is the order in which they are mined.
+
+    Transactions are kept in an append-only list next to a map from digest to list position. Removing a
+    transaction only drops its map entry, and the list is compacted into a new list once most of it is dead.
+    Iterating therefore never copies the pool and never fails when the pool changes meanwhile: transactions
+    added after the iteration started are not yielded, transactions removed meanwhile are skipped.
+
+    The version counts the changes of the pool, so a result derived from the pool (e.g. a block template)
+    can tell whether it is still current.
+    """
+
+    def __init__(self, transactions=()):
+        self.__order = []
+        self.__positions = {}
+        self.version = 0
+        for tx in transactions:
+            self.add(tx)
+
+    def __len__(self):
+        return len(self.__positions)
+
+    def __iter__(self):
+        order, positions = self.__order, self.__positions
+        for position in range(len(order)):
+            tx = order[position]
+            if positions.get(tx.digest) == position:
+                yield tx
+
+    def __contains__(self, transaction):
+        return transaction.digest in self.__positions
+
+    def get(self, digest):
+        """ Returns the open transaction with the given digest or None. """
+        position = self.__positions.get(digest)
+        return None if position is None else self.__order[position]
+
+    def add(self, transaction):
+        """ Adds a transaction unless the pool already contains it.
+
+        :return: True if the transaction was added, False if it is a duplicate.
+        """
+        digest = transaction.digest
+        if digest in self.__positions:
+            return False
+        self.__positions[digest] = len(self.__order)
+        self.__order.append(transaction)
+        self.version += 1
+        return True
+
+    def remove(self, transaction):
+        """ Removes a transaction, e.g. because it was confirmed by a block.
+
+        :return: The removed transaction or None if the pool didn't contain it.
+        """
+        position = self.__positions.pop(transaction.digest, None)
+        if position is None:
+            return None
+        removed = self.__order[position]
+        self.version += 1
+        if len(self.__order) > 2 * len(self.__positions) + 16:
+            self.__compact()
+        return removed
+
+    def __compact(self):
+        # Build new containers instead of changing the old ones, so running iterations keep working
+        order = [tx for position, tx in enumerate(self.__order) if self.__positions.get(tx.digest) == position]
+        self.__positions = {tx.digest: position for position, tx in enumerate(order)}
+        self.__order = order
+
+    def clear(self):
+        self.__order = []
+        self.__positions = {}
+        self.version += 1
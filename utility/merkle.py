@@ -0,0 +1,68 @@
+""" Provides the Merkle tree which commits a block header to the transactions of the block. """
+
+from hashlib import sha256
+
+# Leaves and inner nodes are hashed with different prefixes, so an inner node can't be passed off as a leaf
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+EMPTY_ROOT = sha256(b'').hexdigest()
+
+
+def _hash_leaf(digest):
+    return sha256(LEAF_PREFIX + bytes.fromhex(digest)).digest()
+
+
+def _hash_node(left, right):
+    return sha256(NODE_PREFIX + left + right).digest()
+
+
+def _levels(digests):
+    """ Returns all levels of the tree from the leaves up to the root. A node without a sibling is carried up unchanged. """
+    level = [_hash_leaf(digest) for digest in digests]
+    levels = [level]
+    while len(level) > 1:
+        level = [_hash_node(level[i], level[i + 1]) if i + 1 < len(level) else level[i] for i in range(0, len(level), 2)]
+        levels.append(level)
+    return levels
+
+
+def merkle_root(digests):
+    """ Returns the Merkle root over the given transaction digests as a hex string.
+
+    Arguments:
+        digests: The digests of the transactions in block order.
+    """
+    digests = list(digests)
+    if not digests:
+        return EMPTY_ROOT
+    return _levels(digests)[-1][0].hex()
+
+
+def merkle_path(digests, position):
+    """ Returns the inclusion path of a transaction, i.e. the sibling hashes from its leaf up to the root.
+
+    Arguments:
+        digests: The digests of the transactions in block order.
+        position: The position of the transaction in the block.
+
+    :return: A list of {'hash': ..., 'side': 'left' or 'right'} dicts, where side tells on which side the sibling is.
+    """
+    path = []
+    for level in _levels(list(digests))[:-1]:
+        sibling = position ^ 1
+        if sibling < len(level):
+            path.append({'hash': level[sibling].hex(), 'side': 'left' if sibling < position else 'right'})
+        position //= 2
+    return path
+
+
+def verify_path(digest, path, root):
+    """ Returns whether the inclusion path leads from a transaction digest to the given Merkle root. """
+    try:
+        node = _hash_leaf(digest)
+        for step in path:
+            sibling = bytes.fromhex(step['hash'])
+            node = _hash_node(sibling, node) if step['side'] == 'left' else _hash_node(node, sibling)
+    except (ValueError, KeyError, TypeError):
+        return False
+    return node.hex() == root
@@ -0,0 +1,181 @@
+""" Provides counters, gauges and timers which are rendered in the Prometheus text format.
+
+Recording a value only updates a number in a dict, and gauges are computed by callbacks when the metrics are
+scraped, so instrumenting a hot path costs next to nothing while nobody is looking.
+"""
+
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+class _Metric:
+
+    TYPE = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def header(self):
+        return ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.TYPE)]
+
+
+class Counter(_Metric):
+    """ A value which only goes up, e.g. the number of failed peer requests. """
+
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        return self.header() + ['{}{} {}'.format(self.name, _format_labels(self.label_names, key), value) for key, value in values]
+
+
+class Gauge(_Metric):
+    """ A value which is read from a callback whenever the metrics are rendered, e.g. the chain height. """
+
+    TYPE = 'gauge'
+
+    def __init__(self, name, documentation, function=None):
+        super().__init__(name, documentation)
+        self.function = function
+
+    def set_function(self, function):
+        self.function = function
+
+    def render(self):
+        if self.function is None:
+            return []
+        try:
+            value = self.function()
+        except Exception:
+            return []
+        if value is None:
+            return []
+        return self.header() + ['{} {}'.format(self.name, value)]
+
+
+class CallbackCounter(Gauge):
+    """ A counter which is read from a callback whenever the metrics are rendered, e.g. the hits of a cache which counts them itself. """
+
+    TYPE = 'counter'
+
+
+class Timer(_Metric):
+    """ Counts how often something happened and how many seconds it took in total (a Prometheus summary). """
+
+    TYPE = 'summary'
+
+    def observe(self, seconds, **labels):
+        key = self._key(labels)
+        with self._lock:
+            count, total = self._values.get(key, (0, 0.0))
+            self._values[key] = (count + 1, total + seconds)
+
+    def time(self, **labels):
+        """ Returns a context manager which observes the time spent inside it. """
+        return _Timing(self, labels)
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        lines = self.header()
+        for key, (count, total) in values:
+            labels = _format_labels(self.label_names, key)
+            lines.append('{}_count{} {}'.format(self.name, labels, count))
+            lines.append('{}_sum{} {}'.format(self.name, labels, total))
+        return lines
+
+
+class _Timing:
+
+    def __init__(self, timer, labels):
+        self.timer = timer
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timer.observe(perf_counter() - self.started, **self.labels)
+        return False
+
+
+def timed(timer, **labels):
+    """ Returns a decorator which observes the time every call of the decorated function takes. """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer.time(**labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Registry:
+    """ Holds all metrics of a process and renders them for the /metrics route. """
+
+    def __init__(self):
+        self.__metrics = []
+
+    def register(self, metric):
+        self.__metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.__metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+PROOF_OF_WORK_SECONDS = REGISTRY.register(Timer('smotcoin_proof_of_work_seconds', 'Time spent searching for proofs of work.'))
+PROOF_OF_WORK_HASHES = REGISTRY.register(Counter('smotcoin_proof_of_work_hashes_total', 'Nonces tried while searching for proofs of work.'))
+MINING_ROUNDS_CANCELLED = REGISTRY.register(Counter('smotcoin_mining_rounds_cancelled_total', 'Proof-of-work searches given up because the tip changed or the miner was stopped.'))
+HASHRATE = REGISTRY.register(Gauge('smotcoin_hashrate', 'Hashes per second reached by the last proof-of-work search.'))
+SAVE_DATA_SECONDS = REGISTRY.register(Timer('smotcoin_save_data_seconds', 'Time spent writing blocks, open transactions and peers to disk.', ['operation']))
+LOAD_DATA_SECONDS = REGISTRY.register(Timer('smotcoin_load_data_seconds', 'Time spent loading the stored chain.'))
+TX_INDEX_LOAD_SECONDS = REGISTRY.register(Timer('smotcoin_tx_index_load_seconds', 'Time spent loading the transaction index from its file or rebuilding it from the stored chain.'))
+VERIFY_CHAIN_SECONDS = REGISTRY.register(Timer('smotcoin_verify_chain_seconds', 'Time spent verifying chains.'))
+RESOLVE_SECONDS = REGISTRY.register(Timer('smotcoin_resolve_seconds', 'Time spent resolving conflicts with peer nodes.'))
+CONFLICTS = REGISTRY.register(Counter('smotcoin_conflicts_total', 'Times the chain was found to differ from a peer, so conflicts have to be resolved.'))
+CHAIN_REPLACEMENTS = REGISTRY.register(Counter('smotcoin_chain_replacements_total', 'Times resolving replaced blocks of the local chain with the chain of a peer.'))
+SIGNATURE_SECONDS = REGISTRY.register(Timer('smotcoin_signature_verification_seconds', 'Time spent on RSA signature checks which missed the cache.'))
+SIGNATURE_CACHE_HITS = REGISTRY.register(Counter('smotcoin_signature_cache_hits_total', 'Signature checks answered from the cache.'))
+PEER_REQUEST_SECONDS = REGISTRY.register(Timer('smotcoin_peer_request_seconds', 'Time spent on HTTP requests to peer nodes.', ['peer', 'path']))
+PEER_REQUEST_FAILURES = REGISTRY.register(Counter('smotcoin_peer_request_failures_total', 'HTTP requests to peer nodes which failed or timed out.', ['peer', 'path']))
+LOCK_WAIT_SECONDS = REGISTRY.register(Timer('smotcoin_lock_wait_seconds', 'Time spent waiting for the blockchain lock.', ['lock', 'mode']))
+GOSSIP_MESSAGES = REGISTRY.register(Counter('smotcoin_gossip_messages_total', 'Gossip messages published, received, dropped as duplicates and relayed.', ['path', 'outcome']))
+CHAIN_HEIGHT = REGISTRY.register(Gauge('smotcoin_chain_height', 'Number of blocks in the local chain.'))
+MEMPOOL_SIZE = REGISTRY.register(Gauge('smotcoin_mempool_size', 'Number of open transactions.'))
+PEER_COUNT = REGISTRY.register(Gauge('smotcoin_peer_count', 'Number of known peer nodes.'))
+KEY_CACHE_SIZE = REGISTRY.register(Gauge('smotcoin_key_cache_size', 'Number of parsed public keys in the wallet key cache.'))
+KEY_CACHE_LIMIT = REGISTRY.register(Gauge('smotcoin_key_cache_limit', 'Maximum number of parsed public keys in the wallet key cache.'))
+KEY_CACHE_HITS = REGISTRY.register(CallbackCounter('smotcoin_key_cache_hits_total', 'Public key lookups answered from the wallet key cache.'))
+KEY_CACHE_MISSES = REGISTRY.register(CallbackCounter('smotcoin_key_cache_misses_total', 'Public key lookups which had to parse the key.'))
+VERIFICATION_CACHE_SIZE = REGISTRY.register(Gauge('smotcoin_verification_cache_size', 'Number of signature results in the wallet verification cache.'))
+VERIFICATION_CACHE_LIMIT = REGISTRY.register(Gauge('smotcoin_verification_cache_limit', 'Maximum number of signature results in the wallet verification cache.'))
+# The hits of the verification cache are counted by SIGNATURE_CACHE_HITS
+VERIFICATION_CACHE_MISSES = REGISTRY.register(CallbackCounter('smotcoin_verification_cache_misses_total', 'Signature checks which had to verify the signature.'))
@@ -0,0 +1,252 @@
+""" Provides a multi-core proof-of-work search and a miner which runs it in the background. """
+
+from collections import deque
+from hashlib import sha256
+from multiprocessing import Event, Process, Queue, cpu_count
+from queue import Empty
+import threading
+from time import time
+
+from utility import metrics
+from utility.verification import Verification
+
+
+def _scan(base, zero_bytes, odd, start, stop):
+    """ Tries every proof in [start, stop) and returns the first valid one, or None.
+
+    Arguments:
+        base: A sha256 object which already consumed the transaction/last-hash prefix.
+        zero_bytes: The number of leading digest bytes which have to be zero.
+        odd: Whether the difficulty requires one more zero nibble after those bytes.
+        start: The first proof to try.
+        stop: The proof at which the scan ends (exclusive).
+    """
+    zero_prefix = b'\0' * zero_bytes
+    for proof in range(start, stop):
+        guess = base.copy()
+        guess.update(str(proof).encode())
+        digest = guess.digest()
+        if digest[:zero_bytes] == zero_prefix and (not odd or digest[zero_bytes] < 16):
+            return proof
+    return None
+
+
+def _search(prefix, difficulty, start, stride, chunk_size, stop, results):
+    """ Worker loop: scans every chunk assigned to this worker until a proof is found or the search is stopped.
+
+    Reports a (proof or None, attempts) tuple on the results queue when it exits.
+    """
+    base = sha256(prefix)
+    zero_bytes, odd = divmod(difficulty, 2)
+    attempts = 0
+    chunk_start = start
+    while not stop.is_set():
+        proof = _scan(base, zero_bytes, odd, chunk_start, chunk_start + chunk_size)
+        if proof is not None:
+            results.put((proof, attempts + proof - chunk_start + 1))
+            return
+        attempts += chunk_size
+        chunk_start += stride
+    results.put((None, attempts))
+
+
+class ProofOfWork:
+    """ Searches for a proof which Verification.valid_block_proof accepts.
+
+    The block header is serialized once and fed into a sha256 object whose state is copied for
+    every nonce, so each attempt only hashes the nonce itself. The nonce space is split into chunks which are
+    interleaved across a pool of worker processes; the first worker to find a proof stops the others.
+
+    A search can be cancelled through a callback which is polled after every chunk, e.g. because the tip of
+    the chain changed and the proof would be useless.
+
+    Attributes:
+
+    - workers: The number of processes used for the search (1 searches in the calling process).
+    - chunk_size: The number of nonces a worker tries before checking whether it should stop.
+    - attempts: The number of nonces tried by the last search.
+    - duration: The number of seconds the last search took.
+    """
+
+    CHUNK_SIZE = 20000
+    # Seconds between two checks of the cancel callback while the worker processes are searching
+    POLL_INTERVAL = 0.02
+
+    def __init__(self, workers=None, chunk_size=CHUNK_SIZE):
+        self.workers = workers or cpu_count()
+        self.chunk_size = chunk_size
+        self.attempts = 0
+        self.duration = 0.0
+
+    @property
+    def hashrate(self):
+        """ The number of hashes per second reached by the last search. """
+        return self.attempts / self.duration if self.duration > 0 else 0.0
+
+    def mine_header(self, index, last_hash, merkle_root, timestamp, cancelled=None):
+        """ Returns a proof for a block header with the given fields.
+
+        Arguments:
+            index: The index of the block.
+            last_hash: The hash of the previous block.
+            merkle_root: The Merkle root over all transactions of the block, including the reward transaction.
+            timestamp: The timestamp of the block.
+            cancelled: A function which returns True once the search should be given up (optional).
+
+        :return: The proof or None if the search was cancelled.
+        """
+        return self.__search(Verification.header_prefix(index, last_hash, merkle_root, timestamp), cancelled)
+
+    def __search(self, prefix, cancelled):
+        prefix = prefix.encode()
+        started = time()
+        if self.workers == 1:
+            proof, self.attempts = self.__mine_inline(prefix, cancelled)
+        else:
+            proof, self.attempts = self.__mine_parallel(prefix, cancelled)
+        self.duration = time() - started
+        return proof
+
+    def __mine_inline(self, prefix, cancelled):
+        base = sha256(prefix)
+        zero_bytes, odd = divmod(Verification.DIFFICULTY, 2)
+        chunk_start = 0
+        while cancelled is None or not cancelled():
+            proof = _scan(base, zero_bytes, odd, chunk_start, chunk_start + self.chunk_size)
+            if proof is not None:
+                return proof, proof + 1
+            chunk_start += self.chunk_size
+        return None, chunk_start
+
+    def __mine_parallel(self, prefix, cancelled):
+        stop = Event()
+        results = Queue()
+        stride = self.workers * self.chunk_size
+        processes = [
+            Process(target=_search, args=(prefix, Verification.DIFFICULTY, worker * self.chunk_size, stride,
+                                          self.chunk_size, stop, results), daemon=True)
+            for worker in range(self.workers)
+        ]
+        for process in processes:
+            process.start()
+
+        proof, attempts = None, 0
+        try:
+            running = len(processes)
+            while running:
+                try:
+                    found, worker_attempts = results.get(timeout=self.POLL_INTERVAL)
+                except Empty:
+                    if cancelled is not None and cancelled():
+                        stop.set()
+                    continue
+                running -= 1
+                attempts += worker_attempts
+                if found is not None and proof is None:
+                    proof = found
+                    stop.set()
+        finally:
+            stop.set()
+            for process in processes:
+                process.join()
+        return proof, attempts
+
+
+class BackgroundMiner:
+    """ Mines blocks on the tip of a blockchain in a background thread until it is stopped.
+
+    Every round mines the open transactions on the current tip through Blockchain.mine_block, which gives up
+    as soon as a block from a peer or a resolved conflict changes the tip; the next round then starts on the
+    new tip. Found blocks are broadcast by mine_block and reported through status().
+
+    Attributes:
+
+    - mine_empty: Whether blocks are mined while there are no open transactions.
+    - idle_interval: The number of seconds to wait for open transactions before checking again.
+    """
+
+    IDLE_INTERVAL = 0.5
+    RECENT_BLOCKS = 10
+
+    def __init__(self, blockchain, mine_empty=True, idle_interval=IDLE_INTERVAL):
+        self.blockchain = blockchain
+        self.mine_empty = mine_empty
+        self.idle_interval = idle_interval
+        self.blocks_mined = 0
+        self.rounds_cancelled = 0
+        self.errors = 0
+        self.recent_blocks = deque(maxlen=BackgroundMiner.RECENT_BLOCKS)
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def start(self):
+        """ Starts the mining thread.
+
+        :return: False if the miner was already running.
+        """
+        with self.__lock:
+            if self.running:
+                return False
+            self.__stop.clear()
+            self.__thread = threading.Thread(target=self.__run, name='miner', daemon=True)
+            self.__thread.start()
+            return True
+
+    def stop(self):
+        """ Stops the mining thread, cancelling the running search, and waits until it has exited.
+
+        :return: False if the miner wasn't running.
+        """
+        with self.__lock:
+            if not self.running:
+                return False
+            self.__stop.set()
+            self.__thread.join()
+            self.__thread = None
+            return True
+
+    def status(self):
+        """ Returns a JSON serializable summary of the miner and the blocks it found recently. """
+        return {
+            'running': self.running,
+            'mine_empty': self.mine_empty,
+            'blocks_mined': self.blocks_mined,
+            'rounds_cancelled': self.rounds_cancelled,
+            'errors': self.errors,
+            'hashrate': self.blockchain.miner.hashrate,
+            'recent_blocks': list(self.recent_blocks),
+            'template': None if self.blockchain.public_key is None else self.blockchain.block_template().to_dict()
+        }
+
+    def __run(self):
+        while not self.__stop.is_set():
+            if self.blockchain.public_key is None:
+                print('No wallet set up, stopping the miner.')
+                return
+            # An error in one round, e.g. while resolving with a misbehaving peer, must not stop the miner for good
+            try:
+                self.__round()
+            except Exception as error:
+                self.errors += 1
+                print('Mining round failed: {!r}'.format(error))
+                self.__stop.wait(self.idle_interval)
+
+    def __round(self):
+        if self.blockchain.resolve_conflicts:
+            self.blockchain.resolve()
+            return
+        if not self.mine_empty and not self.blockchain.mempool_size:
+            self.__stop.wait(self.idle_interval)
+            return
+        block = self.blockchain.mine_block(cancelled=self.__stop.is_set)
+        if block is None:
+            self.rounds_cancelled += 1
+            metrics.MINING_ROUNDS_CANCELLED.inc()
+            return
+        self.blocks_mined += 1
+        self.recent_blocks.append({'index': block.index, 'hash': block.hash, 'transactions': len(block.transactions), 'timestamp': block.timestamp})
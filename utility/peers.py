@@ -0,0 +1,168 @@
+""" Provides the table of peer nodes with their health, latency and chain height. """
+
+from threading import Lock
+from time import time
+
+
+class PeerStats:
+    """ What a node knows about one of its peers.
+
+    Attributes:
+
+    - node: The node URL (host:port) of the peer.
+    - latency: The smoothed time the peer takes to answer a request (None until it answered once).
+    - deviation: The smoothed deviation of the latency.
+    - requests: The number of requests which got an answer.
+    - failures: The number of requests in a row which failed; reset once the peer answers.
+    - total_failures: The number of requests which failed overall.
+    - last_seen: The time the peer last answered (None if it never did).
+    - last_failure: The time a request to the peer last failed (None if none did).
+    - height: The chain height the peer reported last (None if unknown).
+    - retry_at: The time before which the peer isn't contacted after failures.
+    """
+
+    __slots__ = ('node', 'latency', 'deviation', 'requests', 'failures', 'total_failures', 'last_seen', 'last_failure', 'height', 'retry_at')
+
+    def __init__(self, node, latency=None, deviation=None, requests=0, failures=0, total_failures=0, last_seen=None,
+                 last_failure=None, height=None, retry_at=0.0):
+        self.node = node
+        self.latency = latency
+        self.deviation = deviation
+        self.requests = requests
+        self.failures = failures
+        self.total_failures = total_failures
+        self.last_seen = last_seen
+        self.last_failure = last_failure
+        self.height = height
+        self.retry_at = retry_at
+
+    @staticmethod
+    def from_dict(stats):
+        """ Rebuilds the stats from the dict returned by to_dict; a plain node URL (older peer files) gets empty stats. """
+        if not isinstance(stats, dict):
+            return PeerStats(stats)
+        return PeerStats(**{name: stats[name] for name in PeerStats.__slots__ if name in stats})
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in PeerStats.__slots__}
+
+
+class PeerTable:
+    """ Tracks the peer nodes and how well they answer, so requests go to healthy peers with fitting timeouts.
+
+    The latency of a peer is smoothed like TCP's round-trip time, and its timeout is the smoothed latency plus
+    four deviations, within [MIN_TIMEOUT, the broadcaster's timeout]. A peer which fails is left alone for a
+    back-off which doubles with every failure in a row, from BASE_BACKOFF up to MAX_BACKOFF; the first request
+    after the back-off probes whether it is back.
+
+    Peers are ranked for syncing by their height first and their latency second.
+    """
+
+    LATENCY_WEIGHT = 0.125
+    DEVIATION_WEIGHT = 0.25
+    MIN_TIMEOUT = 0.25
+    BASE_BACKOFF = 1.0
+    MAX_BACKOFF = 300.0
+
+    def __init__(self, peers=()):
+        self.__peers = {}
+        self.__lock = Lock()
+        self.restore(peers)
+
+    def __len__(self):
+        return len(self.__peers)
+
+    def __contains__(self, node):
+        return node in self.__peers
+
+    def restore(self, peers):
+        """ Adds the peers stored by to_list (or a list of node URLs) to the table. """
+        with self.__lock:
+            for stats in peers:
+                stats = PeerStats.from_dict(stats)
+                self.__peers[stats.node] = stats
+
+    def to_list(self):
+        """ Returns a JSON serializable list of the stats of all peers. """
+        with self.__lock:
+            return [stats.to_dict() for stats in self.__peers.values()]
+
+    def add(self, node):
+        with self.__lock:
+            self.__peers.setdefault(node, PeerStats(node))
+
+    def remove(self, node):
+        with self.__lock:
+            self.__peers.pop(node, None)
+
+    def nodes(self):
+        """ Returns the node URLs of all peers. """
+        with self.__lock:
+            return list(self.__peers)
+
+    def available(self, node, now=None):
+        """ Returns whether a request may be sent to the peer, i.e. it isn't backing off after failures. """
+        stats = self.__peers.get(node)
+        return stats is None or stats.retry_at <= (time() if now is None else now)
+
+    def reachable(self, nodes):
+        """ Returns the given peers which aren't backing off after failures. """
+        now = time()
+        return [node for node in nodes if self.available(node, now)]
+
+    def timeout(self, node, default):
+        """ Returns the timeout for a request to the peer.
+
+        Arguments:
+            node: The node URL of the peer.
+            default: The longest timeout, which is also used until the peer answered once.
+        """
+        stats = self.__peers.get(node)
+        if stats is None or stats.latency is None:
+            return default
+        return min(max(stats.latency + 4 * stats.deviation, self.MIN_TIMEOUT), default)
+
+    def record_success(self, node, latency):
+        """ Records that the peer answered a request after the given number of seconds. """
+        with self.__lock:
+            stats = self.__peers.get(node)
+            if stats is None:
+                return
+            if stats.latency is None:
+                stats.latency, stats.deviation = latency, latency / 2
+            else:
+                stats.deviation += self.DEVIATION_WEIGHT * (abs(latency - stats.latency) - stats.deviation)
+                stats.latency += self.LATENCY_WEIGHT * (latency - stats.latency)
+            stats.requests += 1
+            stats.failures = 0
+            stats.retry_at = 0.0
+            stats.last_seen = time()
+
+    def record_failure(self, node):
+        """ Records that a request to the peer failed and starts its back-off.
+
+        :return: The number of seconds the peer is left alone.
+        """
+        with self.__lock:
+            stats = self.__peers.get(node)
+            if stats is None:
+                return 0.0
+            stats.failures += 1
+            stats.total_failures += 1
+            stats.last_failure = time()
+            backoff = min(self.BASE_BACKOFF * 2 ** (stats.failures - 1), self.MAX_BACKOFF)
+            stats.retry_at = stats.last_failure + backoff
+            return backoff
+
+    def record_height(self, node, height):
+        with self.__lock:
+            stats = self.__peers.get(node)
+            if stats is not None:
+                stats.height = height
+
+    def rank(self, nodes):
+        """ Returns the given peers ordered for syncing: the highest chain first, and the fastest among equal heights. """
+        def key(node):
+            stats = self.__peers.get(node) or PeerStats(node)
+            return (-(stats.height or 0), float('inf') if stats.latency is None else stats.latency)
+        return sorted(nodes, key=key)
@@ -0,0 +1,472 @@
+""" Provides the on-disk storage of the blockchain, the open transactions and the peer nodes. """
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from json import dumps, loads
+import mmap
+import os
+import struct
+from threading import Lock
+
+from block import Block
+from transaction import Transaction
+from utility import codec, metrics
+
+LOG_MAGIC = b'SMOTLOG1'
+INDEX_MAGIC = b'SMOTIDX1'
+GENERATION_SIZE = 8
+HEADER_SIZE = len(LOG_MAGIC) + GENERATION_SIZE
+RECORD_HEADER = struct.Struct('>I')
+INDEX_ENTRY = struct.Struct('>Q')
+
+
+def encode_block(block):
+    """ Serializes a block into the payload of a log record. """
+    return codec.encode_block(block)
+
+
+def decode_block(payload):
+    """ Rebuilds a block from the payload of a log record, which is either binary or JSON (older logs). """
+    if payload[:1] == b'{':
+        return Block.from_dict(loads(bytes(payload).decode()))
+    return codec.decode_block(payload)
+
+
+def _fsync_directory(path):
+    """ Makes a rename inside the given directory durable (best effort, not every platform supports it). """
+    try:
+        fd = os.open(path or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def atomic_writer(path):
+    """ Returns a context manager yielding a file whose content replaces the given file once the block is left.
+
+    Readers see either the old or the new content, even after a crash. If the block raises, the file is
+    left unchanged.
+
+    Arguments:
+        path: The file which should be written.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, mode='wb') as file:
+        yield file
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    _fsync_directory(os.path.dirname(path))
+
+
+def atomic_write(path, data):
+    """ Replaces the content of a file so that readers see either the old or the new content, even after a crash.
+
+    Arguments:
+        path: The file which should be written.
+        data: The bytes which should be stored.
+    """
+    with atomic_writer(path) as file:
+        file.write(data)
+
+
+class BlockStore:
+    """ Stores the blockchain in an append-only log of block records with an offset index.
+
+    Every record in the log is a 4 byte length followed by the binary encoding of a block (see utility.codec);
+    JSON records written by older versions are still read. The index holds the 8 byte offset
+    of every record, so the n-th block can be read without scanning the log. Log and index both start with a
+    random generation id which is renewed whenever the log is rewritten; an index whose generation doesn't match
+    the log, or which is missing records, is rebuilt from the log when the store is opened. A record which was
+    only partially written before a crash is cut off.
+
+    The index is kept in memory as the raw entries and only unpacked for the blocks which are read, so opening
+    the store doesn't depend on the chain length beyond reading the index file. Blocks are read through a
+    read-only memory map of the log, so a read is a copy out of the page cache instead of a file open and seek;
+    the map is renewed when the log grows beyond it, and dropped before the log is cut or replaced.
+
+    The open transactions, the peer nodes and the checkpoint are small and change independently of the chain,
+    so they live in separate JSON files which are replaced atomically. The transaction index keeps its own side
+    file next to the log (see TransactionIndex).
+    """
+
+    def __init__(self, node_id):
+        self.log_path = 'blockchain-{}.log'.format(node_id)
+        self.index_path = 'blockchain-{}.idx'.format(node_id)
+        self.mempool_path = 'mempool-{}.json'.format(node_id)
+        self.peers_path = 'peers-{}.json'.format(node_id)
+        self.checkpoint_path = 'checkpoint-{}.json'.format(node_id)
+        self.tx_index_path = 'txindex-{}.log'.format(node_id)
+        self.legacy_path = 'blockchain-{}.txt'.format(node_id)
+        self.__index = bytearray()
+        self.__generation = None
+        self.__map = None
+        # Guards the memory map: it must not be read while the log is cut, which would fault on the lost pages
+        self.__map_lock = Lock()
+        if os.path.exists(self.log_path):
+            self.__recover()
+
+    @property
+    def height(self):
+        """ The number of blocks in the log. """
+        return len(self.__index) // INDEX_ENTRY.size
+
+    @property
+    def generation(self):
+        """ The id of the current log; it changes whenever the log is rewritten. """
+        return None if self.__generation is None else self.__generation.hex()
+
+    def exists(self):
+        return self.__generation is not None
+
+    def offset(self, index):
+        """ Returns the position of a block record in the log. """
+        return INDEX_ENTRY.unpack_from(self.__index, index * INDEX_ENTRY.size)[0]
+
+    def __recover(self):
+        """ Brings the index in line with the log after an unclean shutdown. """
+        with open(self.log_path, mode='rb') as log:
+            header = log.read(HEADER_SIZE)
+            if len(header) < HEADER_SIZE or header[:len(LOG_MAGIC)] != LOG_MAGIC:
+                print('Block log is damaged, ignoring it.')
+                return
+            self.__generation = header[len(LOG_MAGIC):]
+
+            log_size = os.fstat(log.fileno()).st_size
+            entries, aligned = self.__read_index()
+            end = HEADER_SIZE
+            if entries:
+                last_offset = INDEX_ENTRY.unpack_from(entries, len(entries) - INDEX_ENTRY.size)[0]
+                log.seek(last_offset)
+                length = log.read(RECORD_HEADER.size)
+                if len(length) < RECORD_HEADER.size:
+                    end = log_size + 1
+                else:
+                    end = last_offset + RECORD_HEADER.size + RECORD_HEADER.unpack(length)[0]
+            if end > log_size:
+                # The index points past the end of the log, so it can't be trusted
+                entries, end = bytearray(), HEADER_SIZE
+
+            indexed = len(entries) if aligned else None
+            log.seek(end)
+            while True:
+                length = log.read(RECORD_HEADER.size)
+                if len(length) < RECORD_HEADER.size:
+                    break
+                record_end = end + RECORD_HEADER.size + RECORD_HEADER.unpack(length)[0]
+                if record_end > log_size:
+                    break
+                entries += INDEX_ENTRY.pack(end)
+                end = record_end
+                log.seek(end)
+
+        if end < log_size:
+            print('Cutting off an incomplete block record.')
+            with open(self.log_path, mode='r+b') as log:
+                log.truncate(end)
+                log.flush()
+                os.fsync(log.fileno())
+        self.__index = entries
+        if len(entries) != indexed:
+            self.__write_index()
+
+    def __read_index(self):
+        """ Returns the entries stored in the index and whether the index file ends on an entry boundary. """
+        try:
+            with open(self.index_path, mode='rb') as index:
+                content = index.read()
+        except IOError:
+            return bytearray(), False
+        if content[:len(INDEX_MAGIC)] != INDEX_MAGIC or content[len(INDEX_MAGIC):HEADER_SIZE] != self.__generation:
+            return bytearray(), False
+        count, remainder = divmod(len(content) - HEADER_SIZE, INDEX_ENTRY.size)
+        return bytearray(content[HEADER_SIZE:HEADER_SIZE + count * INDEX_ENTRY.size]), remainder == 0
+
+    def __write_index(self):
+        atomic_write(self.index_path, INDEX_MAGIC + self.__generation + bytes(self.__index))
+
+    def iter_blocks(self, start=0, stop=None):
+        """ Reads the blocks in [start, stop) one after another.
+
+        Arguments:
+            start: The index of the first block (default = 0).
+            stop: The index after the last block (default = the height of the log).
+        """
+        stop = self.height if stop is None else min(stop, self.height)
+        for index in range(start, stop):
+            yield self.read_block(index)
+
+    def read_block(self, index):
+        """ Reads a single block through the offset index.
+
+        Arguments:
+            index: The position of the block in the chain.
+        """
+        return decode_block(self.read_payload(index))
+
+    def read_payload(self, index):
+        """ Returns a copy of the encoded block at the given position, read from the memory map of the log.
+
+        Raises IndexError if the log holds no block at that position (any more).
+        """
+        with self.__map_lock:
+            if not 0 <= index < self.height:
+                raise IndexError('Block index out of range.')
+            offset = self.offset(index)
+            start = offset + RECORD_HEADER.size
+            length = RECORD_HEADER.unpack_from(self.__mapped(start), offset)[0]
+            return self.__mapped(start + length)[start:start + length]
+
+    def __mapped(self, size):
+        """ Returns a memory map of the log which covers at least its first size bytes. """
+        if self.__map is None or len(self.__map) < size:
+            self.__unmap()
+            with open(self.log_path, mode='rb') as log:
+                self.__map = mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.__map
+
+    def __unmap(self):
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+
+    @metrics.timed(metrics.SAVE_DATA_SECONDS, operation='append_block')
+    def append_block(self, block):
+        """ Appends a block to the log and makes it durable before it is added to the index.
+
+        Arguments:
+            block: The block which was appended to the chain.
+        """
+        payload = encode_block(block)
+        with open(self.log_path, mode='ab') as log:
+            offset = log.tell()
+            log.write(RECORD_HEADER.pack(len(payload)) + payload)
+            log.flush()
+            os.fsync(log.fileno())
+        entry = INDEX_ENTRY.pack(offset)
+        with open(self.index_path, mode='ab') as index:
+            index.write(entry)
+            index.flush()
+            os.fsync(index.fileno())
+        self.__index += entry
+
+    @metrics.timed(metrics.SAVE_DATA_SECONDS, operation='truncate')
+    def truncate(self, height):
+        """ Cuts the log back to its first blocks, e.g. before the suffix of a peer's chain is appended.
+
+        The shortened index is written first: if the node crashes before the log is cut, the records behind it
+        are picked up again when the store is opened, which leaves the old, consistent chain.
+
+        Arguments:
+            height: The number of blocks which should be kept.
+        """
+        if height >= self.height:
+            return
+        with self.__map_lock:
+            end = self.offset(height)
+            self.__index = self.__index[:height * INDEX_ENTRY.size]
+            self.__write_index()
+            self.__unmap()
+            with open(self.log_path, mode='r+b') as log:
+                log.truncate(end)
+                log.flush()
+                os.fsync(log.fileno())
+
+    @metrics.timed(metrics.SAVE_DATA_SECONDS, operation='rewrite')
+    def rewrite(self, chain):
+        """ Replaces the whole log, e.g. because the chain was replaced by a peer's chain.
+
+        The records are written one by one as the blocks are iterated, so the chain may be read from this store
+        and is never held in memory as a whole.
+
+        Arguments:
+            chain: The blocks which should be stored.
+        """
+        generation = os.urandom(GENERATION_SIZE)
+        entries = bytearray()
+        offset = HEADER_SIZE
+        with atomic_writer(self.log_path) as log:
+            log.write(LOG_MAGIC + generation)
+            for block in chain:
+                payload = encode_block(block)
+                log.write(RECORD_HEADER.pack(len(payload)) + payload)
+                entries += INDEX_ENTRY.pack(offset)
+                offset += RECORD_HEADER.size + len(payload)
+        with self.__map_lock:
+            self.__unmap()
+            self.__generation = generation
+            self.__index = entries
+        self.__write_index()
+
+    def load_checkpoint(self):
+        """ Returns the stored checkpoint or None if there is none. """
+        try:
+            with open(self.checkpoint_path, mode='r') as file:
+                return loads(file.read())
+        except (IOError, ValueError):
+            return None
+
+    @metrics.timed(metrics.SAVE_DATA_SECONDS, operation='checkpoint')
+    def save_checkpoint(self, checkpoint):
+        atomic_write(self.checkpoint_path, dumps(checkpoint).encode())
+
+    def load_open_transactions(self):
+        """ Returns the stored open transactions. """
+        try:
+            with open(self.mempool_path, mode='r') as file:
+                return [Transaction.from_dict(tx) for tx in loads(file.read())]
+        except (IOError, ValueError):
+            return []
+
+    @metrics.timed(metrics.SAVE_DATA_SECONDS, operation='open_transactions')
+    def save_open_transactions(self, open_transactions):
+        atomic_write(self.mempool_path, dumps([tx.to_dict() for tx in open_transactions]).encode())
+
+    def load_peer_nodes(self):
+        """ Returns the stored peer nodes, as dicts of their stats or as node URLs (older files). """
+        try:
+            with open(self.peers_path, mode='r') as file:
+                return loads(file.read())
+        except (IOError, ValueError):
+            return []
+
+    @metrics.timed(metrics.SAVE_DATA_SECONDS, operation='peer_nodes')
+    def save_peer_nodes(self, peer_nodes):
+        atomic_write(self.peers_path, dumps(list(peer_nodes)).encode())
+
+    def migrate_legacy(self):
+        """ Imports a blockchain-<node_id>.txt file written by older versions of the node.
+
+        The legacy file is left untouched; the log takes precedence once it exists.
+
+        :return: True if a legacy file was found and imported.
+        """
+        try:
+            with open(self.legacy_path, mode='r') as file:
+                file_content = file.readlines()
+                chain = [Block.from_dict(block) for block in loads(file_content[0][:-1])]
+                open_transactions = [Transaction.from_dict(tx) for tx in loads(file_content[1][:-1])]
+                peer_nodes = loads(file_content[2])
+        except (IOError, IndexError, ValueError):
+            return False
+
+        self.save_open_transactions(open_transactions)
+        self.save_peer_nodes(peer_nodes)
+        self.rewrite(chain)
+        print('Migrated {} blocks from {}.'.format(len(chain), self.legacy_path))
+        return True
+
+
+class StoredChain:
+    """ A read-mostly sequence of the blocks in a BlockStore which keeps only a hot tail of blocks in memory.
+
+    Only the tip is loaded when the chain is opened. Appended blocks stay in memory until they fall out of the
+    hot tail of the last hot_blocks blocks. Older blocks are read from the memory-mapped log through the offset
+    index when they are accessed and kept in a small LRU cache, so the memory a node needs doesn't grow with
+    its chain. Like a list, the chain supports len(), indexing (including negative indices and slices),
+    iteration and append().
+
+    Any number of threads may read from the chain at the same time, while appending is left to one thread.
+
+    Arguments:
+        store: The BlockStore holding the blocks.
+        cache_size: The number of historical blocks which are kept after they were loaded.
+        hot_blocks: The number of blocks at the tip which are kept in memory (at least 1).
+    """
+
+    CACHE_SIZE = 1024
+    HOT_BLOCKS = 256
+
+    def __init__(self, store, cache_size=CACHE_SIZE, hot_blocks=HOT_BLOCKS):
+        self.__store = store
+        self.__height = store.height
+        self.__cache_size = cache_size
+        self.hot_blocks = max(hot_blocks, 1)
+        self.__cache = OrderedDict()
+        self.__cache_lock = Lock()
+        # All blocks from live_from on are kept in memory; blocks from pinned_from on are no longer in the store
+        self.__live = {}
+        self.__live_from = max(self.__height - 1, 0)
+        self.__pinned_from = None
+        if self.__height:
+            self.__live[self.__height - 1] = store.read_block(self.__height - 1)
+
+    def __len__(self):
+        return self.__height
+
+    @property
+    def live_blocks(self):
+        """ The number of blocks which are kept in memory outside of the cache. """
+        return len(self.__live)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(self.__height))]
+        if index < 0:
+            index += self.__height
+        if not 0 <= index < self.__height:
+            raise IndexError('Block index out of range.')
+        block = self.__live.get(index)
+        if block is not None:
+            return block
+        with self.__cache_lock:
+            block = self.__cache.get(index)
+            if block is not None:
+                self.__cache.move_to_end(index)
+                return block
+        block = self.__read(index)
+        with self.__cache_lock:
+            self.__cache[index] = block
+            if len(self.__cache) > self.__cache_size:
+                self.__cache.popitem(last=False)
+        return block
+
+    def __read(self, index):
+        try:
+            return self.__store.read_block(index)
+        except IndexError:
+            # The block was cut from the store after it was checked in memory, so it is retained there now
+            return self.__live[index]
+
+    def __iter__(self):
+        return self.iter_blocks()
+
+    def iter_blocks(self, start=0, stop=None):
+        """ Returns an iterator over the blocks in [start, stop) as they were when the iterator was created.
+
+        Stored blocks are read from the memory map of the log without displacing the blocks in the cache.
+        """
+        stop = self.__height if stop is None else min(stop, self.__height)
+        return self.__iter_blocks(max(start, 0), stop)
+
+    def __iter_blocks(self, start, stop):
+        for index in range(start, stop):
+            block = self.__live.get(index)
+            yield block if block is not None else self.__read(index)
+
+    def append(self, block):
+        """ Appends a block which is also appended to the store; it stays in memory while it is in the hot tail. """
+        self.__live[self.__height] = block
+        self.__height += 1
+        # Blocks which leave the hot tail are in the store, since they were appended to it after the chain
+        while self.__height - self.__live_from > self.hot_blocks and (self.__pinned_from is None or self.__live_from < self.__pinned_from):
+            self.__live.pop(self.__live_from, None)
+            self.__live_from += 1
+
+    def retain(self, start, blocks):
+        """ Keeps the blocks from start on in memory, e.g. before they are cut from the store.
+
+        Arguments:
+            start: The index of the first block.
+            blocks: The blocks from start up to the height of the chain.
+        """
+        for index, block in enumerate(blocks, start):
+            self.__live[index] = block
+        self.__live_from = min(self.__live_from, start)
+        self.__pinned_from = start if self.__pinned_from is None else min(self.__pinned_from, start)
@@ -0,0 +1,102 @@
+""" Provides the assembly of block templates, i.e. the open transactions the next block is mined with. """
+
+from utility import codec
+from wallet import Wallet
+
+
+class BlockTemplate:
+    """ The open transactions selected for a block on a given tip.
+
+    Attributes:
+
+    - last_hash: The hash of the block the template is built on.
+    - mempool_version: The version of the open transactions the template was built from.
+    - transactions: The selected transactions in block order, without the reward transaction.
+    - invalid: The transactions which were left out because their signature is invalid.
+    - size: The encoded size of the selected transactions in bytes, including the reserved bytes.
+    """
+
+    def __init__(self, last_hash, mempool_version, transactions, invalid, size):
+        self.last_hash = last_hash
+        self.mempool_version = mempool_version
+        self.transactions = transactions
+        self.invalid = invalid
+        self.size = size
+
+    def is_current(self, last_hash, mempool_version):
+        """ Returns whether the template was built on the given tip from the given version of the open transactions. """
+        return self.last_hash == last_hash and self.mempool_version == mempool_version
+
+    def to_dict(self):
+        """ Returns a JSON serializable summary of the template. """
+        return {
+            'last_hash': self.last_hash,
+            'transactions': len(self.transactions),
+            'invalid': len(self.invalid),
+            'size': self.size
+        }
+
+
+class TemplateBuilder:
+    """ Selects the open transactions for the next block, up to a number of transactions and a number of bytes.
+
+    The transactions are taken in the order of the priority: 'arrival' takes the oldest first, 'amount' the
+    largest amounts first (and the oldest among equal amounts). A transaction which doesn't fit into the bytes
+    which are left is passed over for smaller ones; all transactions which aren't selected stay open for the
+    next block.
+
+    Signatures are checked through the verification cache of the wallet, so transactions which were verified
+    when they were received aren't verified again.
+
+    Attributes:
+
+    - max_transactions: The maximum number of transactions of a block, not counting the reward transaction.
+    - max_bytes: The maximum encoded size of the transactions of a block in bytes.
+    - priority: The order in which the open transactions are selected, one of PRIORITIES.
+    """
+
+    PRIORITIES = ('arrival', 'amount')
+    MAX_TRANSACTIONS = 1000
+    MAX_BYTES = 1000000
+
+    def __init__(self, max_transactions=MAX_TRANSACTIONS, max_bytes=MAX_BYTES, priority='arrival'):
+        if priority not in TemplateBuilder.PRIORITIES:
+            raise ValueError('Unknown priority {}, expected one of {}.'.format(priority, ', '.join(TemplateBuilder.PRIORITIES)))
+        self.max_transactions = max_transactions
+        self.max_bytes = max_bytes
+        self.priority = priority
+
+    def order(self, transactions):
+        """ Returns the transactions in the order in which they are selected. Arrival order is taken as it is. """
+        if self.priority == 'amount':
+            # The sort is stable, so equal amounts keep their arrival order
+            return sorted(transactions, key=lambda tx: tx.amount, reverse=True)
+        return transactions
+
+    def build(self, transactions, last_hash, mempool_version, reserved_bytes=0):
+        """ Builds a template from the open transactions.
+
+        Arguments:
+            transactions: The open transactions in arrival order; any iterable, which is only consumed as far as
+                needed if the priority is 'arrival'.
+            last_hash: The hash of the block the template is built on.
+            mempool_version: The version of the open transactions.
+            reserved_bytes: The number of bytes which are kept free, e.g. for the reward transaction.
+
+        :return: The BlockTemplate.
+        """
+        selected = []
+        invalid = []
+        size = reserved_bytes
+        for tx in self.order(transactions):
+            if len(selected) >= self.max_transactions or size >= self.max_bytes:
+                break
+            tx_size = len(codec.encode_transaction(tx))
+            if size + tx_size > self.max_bytes:
+                continue
+            if not Wallet.verify_transaction(tx):
+                invalid.append(tx)
+                continue
+            selected.append(tx)
+            size += tx_size
+        return BlockTemplate(last_hash, mempool_version, selected, invalid, size)
@@ -0,0 +1,291 @@
+""" Provides an incrementally maintained index of the confirmed transactions. """
+
+from json import dumps, loads
+import os
+from threading import Event, Lock, Thread
+
+from utility import metrics
+from utility.storage import atomic_writer
+
+INDEX_LOG_MAGIC = 'smotcoin-txindex-1'
+
+
+class TransactionIndex:
+    """ Maps transaction ids and addresses to the positions of their transactions in the chain.
+
+    A transaction id is the digest of the transaction. A position is a (block index, transaction index) tuple.
+    Mining rewards of the same miner have the same digest, so an id can have several positions. The positions
+    of an address are kept in chain order, covering every transaction it sent or received.
+
+    With a path, the index is persisted in an append-only side file next to the block log: a header line with
+    the generation of the block log, then one JSON line per block with the hash of the block and the digest,
+    sender and recipient of each of its transactions. A line is appended when a block is applied and cut off
+    when it is reverted. The file isn't synced, since it can always be rebuilt from the block log.
+
+    open loads the file in a background thread, which doesn't take the lock of the chain. Blocks which are
+    applied or reverted meanwhile are queued and replayed once the file is loaded; lookups have to wait for
+    that (see wait). The file is used as far as its generation matches the block log and its line for the
+    last block it shares with the chain has that block's hash; blocks the file misses are indexed from the
+    chain, and a file which doesn't match is rebuilt from it.
+
+    Arguments:
+        path: The side file the index is persisted in (optional).
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.__transactions = {}
+        self.__addresses = {}
+        # The offsets of the lines of the blocks in the side file and the offset of its end
+        self.__offsets = []
+        self.__end = 0
+        self.__ready = Event()
+        self.__ready.set()
+        # Blocks which are applied (True) or reverted (False) while the side file is loaded
+        self.__backlog = None
+        self.__lock = Lock()
+
+    @property
+    def ready(self):
+        """ Whether the index is loaded and can be looked up. """
+        return self.__ready.is_set()
+
+    def wait(self):
+        """ Waits until the index is loaded. Call it before taking the lock of the chain, since loading doesn't need that lock. """
+        self.__ready.wait()
+
+    def rebuild(self, chain):
+        """ Discards the current state and indexes all blocks of a chain, without touching the side file.
+
+        Arguments:
+            chain: The blocks which should be indexed.
+        """
+        self.__transactions = {}
+        self.__addresses = {}
+        for block in chain:
+            self.__index_block(block)
+
+    def open(self, generation, chain):
+        """ Starts to load the index from the side file in the background.
+
+        Arguments:
+            generation: The generation of the block log the chain is stored in.
+            chain: The stored chain; it is read in the background, so it must keep its blocks, e.g. a StoredChain.
+        """
+        with self.__lock:
+            self.__ready.clear()
+            self.__backlog = []
+        Thread(target=self.__load, args=(generation, chain, len(chain)), name='tx-index', daemon=True).start()
+
+    def retag(self, generation):
+        """ Marks the side file as belonging to a rewritten block log with the same blocks. """
+        self.wait()
+        with self.__lock:
+            if self.path is None:
+                return
+            records = b''
+            if os.path.exists(self.path):
+                with open(self.path, mode='rb') as file:
+                    file.seek(self.__offsets[0] if self.__offsets else self.__end)
+                    records = file.read(self.__end - file.tell())
+            self.__write(generation, records.splitlines(keepends=True))
+
+    def __load(self, generation, chain, height):
+        try:
+            with metrics.TX_INDEX_LOAD_SECONDS.time():
+                try:
+                    loaded = self.__load_file(generation, chain, height)
+                except (ValueError, TypeError, KeyError, IndexError):
+                    loaded = False
+                if not loaded:
+                    if os.path.exists(self.path):
+                        print('Transaction index does not match the chain, rebuilding it.')
+                    self.__rebuild_file(generation, chain, height)
+        finally:
+            with self.__lock:
+                for applied, block in self.__backlog:
+                    if applied:
+                        self.__index_block(block)
+                        self.__append(block)
+                    else:
+                        self.__unindex_block(block)
+                        self.__cut(len(self.__offsets) - 1)
+                self.__backlog = None
+                self.__ready.set()
+
+    def __load_file(self, generation, chain, height):
+        """ Loads the index from the side file and indexes the blocks it misses.
+
+        :return: False if the side file can't be used for the chain.
+        """
+        records = self.__read(generation)
+        if records is None:
+            return False
+        shared = min(len(records), height)
+        if shared and records[shared - 1][0] != chain[shared - 1].hash:
+            return False
+        self.__transactions = {}
+        self.__addresses = {}
+        for block_index, (block_hash, entries) in enumerate(records[:shared]):
+            for number, (digest, sender, recipient) in enumerate(entries):
+                position = (block_index, number)
+                self.__add(self.__transactions, digest, position)
+                self.__add(self.__addresses, sender, position)
+                self.__add(self.__addresses, recipient, position)
+        self.__cut(shared)
+        for block in chain.iter_blocks(shared, height):
+            self.__index_block(block)
+            self.__append(block)
+        return True
+
+    def __rebuild_file(self, generation, chain, height):
+        self.__transactions = {}
+        self.__addresses = {}
+        lines = []
+        for block in chain.iter_blocks(0, height):
+            self.__index_block(block)
+            lines.append(self.__line(block))
+        self.__write(generation, lines)
+
+    def __read(self, generation):
+        """ Reads the lines of the side file, or returns None if there is none for the given generation.
+
+        :return: A list of (block hash, [[digest, sender, recipient], ...]) tuples; a line which was only
+            partially written before a crash ends the list.
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        with open(self.path, mode='rb') as file:
+            data = file.read()
+        lines = data.split(b'\n')
+        if len(lines) < 2:
+            return None
+        try:
+            header = loads(lines[0])
+            if header.get('magic') != INDEX_LOG_MAGIC or header.get('generation') != generation:
+                return None
+        except (ValueError, AttributeError):
+            return None
+        records = []
+        offsets = []
+        offset = len(lines[0]) + 1
+        # The part after the last newline is empty, or a line which wasn't finished
+        for line in lines[1:-1]:
+            try:
+                block_hash, entries = loads(line)
+            except (ValueError, TypeError):
+                break
+            records.append((block_hash, entries))
+            offsets.append(offset)
+            offset += len(line) + 1
+        self.__offsets = offsets
+        self.__end = offset
+        if offset < len(data):
+            # Drops the unfinished line, so the next line is appended right after the last complete one
+            with open(self.path, mode='r+b') as file:
+                file.truncate(offset)
+        return records
+
+    def __write(self, generation, lines):
+        """ Replaces the side file with a header for the given generation and the given block lines. """
+        if self.path is None:
+            return
+        header = (dumps({'magic': INDEX_LOG_MAGIC, 'generation': generation}) + '\n').encode()
+        self.__offsets = []
+        offset = len(header)
+        with atomic_writer(self.path) as file:
+            file.write(header)
+            for line in lines:
+                file.write(line)
+                self.__offsets.append(offset)
+                offset += len(line)
+        self.__end = offset
+
+    @staticmethod
+    def __line(block):
+        return (dumps([block.hash, [[tx.digest, tx.sender, tx.recipient] for tx in block.transactions]]) + '\n').encode()
+
+    def __append(self, block):
+        if self.path is None:
+            return
+        line = self.__line(block)
+        with open(self.path, mode='ab') as file:
+            file.write(line)
+        self.__offsets.append(self.__end)
+        self.__end += len(line)
+
+    def __cut(self, count):
+        """ Cuts the side file back to the lines of its first blocks. """
+        if self.path is None or count >= len(self.__offsets):
+            return
+        self.__end = self.__offsets[count]
+        del self.__offsets[count:]
+        with open(self.path, mode='r+b') as file:
+            file.truncate(self.__end)
+
+    def __add(self, index, key, position):
+        positions = index.get(key)
+        if positions is None:
+            index[key] = [position]
+        elif positions[-1] != position:
+            positions.append(position)
+
+    def __index_block(self, block):
+        for number, tx in enumerate(block.transactions):
+            position = (block.index, number)
+            self.__add(self.__transactions, tx.digest, position)
+            self.__add(self.__addresses, tx.sender, position)
+            self.__add(self.__addresses, tx.recipient, position)
+
+    def apply_block(self, block):
+        """ Indexes all transactions of a newly appended block.
+
+        Arguments:
+            block: The block which was appended to the chain.
+        """
+        with self.__lock:
+            if self.__backlog is not None:
+                self.__backlog.append((True, block))
+                return
+            self.__index_block(block)
+            self.__append(block)
+
+    def __remove(self, index, key, block_index):
+        positions = index.get(key)
+        while positions and positions[-1][0] >= block_index:
+            positions.pop()
+        if positions == []:
+            del index[key]
+
+    def __unindex_block(self, block):
+        for tx in block.transactions:
+            self.__remove(self.__transactions, tx.digest, block.index)
+            self.__remove(self.__addresses, tx.sender, block.index)
+            self.__remove(self.__addresses, tx.recipient, block.index)
+
+    def revert_block(self, block):
+        """ Undoes apply_block for a block which was removed from the chain. Blocks have to be reverted tip first. """
+        with self.__lock:
+            if self.__backlog is not None:
+                self.__backlog.append((False, block))
+                return
+            self.__unindex_block(block)
+            self.__cut(len(self.__offsets) - 1)
+
+    def locate(self, tx_id):
+        """ Returns the positions of the transaction with the given id (empty if it isn't confirmed).
+
+        Arguments:
+            tx_id: The digest of the transaction.
+        """
+        return list(self.__transactions.get(tx_id, ()))
+
+    def address_positions(self, address):
+        """ Returns the positions of all transactions an address sent or received, in chain order.
+
+        The returned list belongs to the index and must not be modified.
+
+        Arguments:
+            address: The public key of the participant.
+        """
+        return self.__addresses.get(address, [])
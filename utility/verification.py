@@ -1,37 +1,167 @@
 """ Provides verification helper methods. """
 
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from json import dumps
+from os import cpu_count
+
+from block import Block
+from utility import metrics
 from utility.hash_util import hash_block, hash_string_256
 from wallet import Wallet
 
 
+def _hash_blocks(blocks):
+    return [hash_block(block) for block in blocks]
+
+
+def _check_proofs(blocks):
+    return [Verification.valid_block_proof(block) for block in blocks]
+
+
+def _chunks(items, count):
+    size = max(1, -(-len(items) // count))
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
 class Verification:
 
     DIFFICULTY = 4
+    # Chains with fewer blocks than this are verified in-process, since starting the pool would cost more than it saves
+    PARALLEL_THRESHOLD = 256
+    VERIFIED_CACHE_SIZE = 100000
+    # The number of blocks which are verified together
+    WINDOW_SIZE = 4096
+
+    __verified_hashes = OrderedDict()
+    __executor = None
+
+    @staticmethod
+    def proof_prefix(transactions, last_hash):
+        """ Returns the part of a proof-of-work guess which doesn't depend on the proof itself. """
+        return str([tx.to_ordered_dict() for tx in transactions]) + str(last_hash)
 
     @staticmethod
-    def valid_proof(transactions, last_hash, proof):
-        guess = (str([tx.to_ordered_dict() for tx in transactions]) + str(last_hash) + str(proof)).encode()
-        guess_hash = hash_string_256(guess)
+    def header_prefix(index, last_hash, merkle_root, timestamp, version=Block.VERSION):
+        """ Returns the part of a proof-of-work guess for a versioned block header which doesn't depend on the proof.
+
+        It is the canonical serialization of all fields of the header but the proof, so the proof of work covers
+        the same fields as the hash of the block. Unlike the prefix of version 1 blocks, it has a fixed size and
+        covers the mining reward as well.
+        """
+        return dumps({
+            'version': version,
+            'index': index,
+            'previous_hash': last_hash,
+            'merkle_root': merkle_root,
+            'timestamp': timestamp
+        }, sort_keys=True) + ':'
+
+    @staticmethod
+    def __valid_guess(prefix, proof):
+        guess_hash = hash_string_256((prefix + str(proof)).encode())
         return guess_hash[0:Verification.DIFFICULTY] == ('0' * Verification.DIFFICULTY)
 
+    @classmethod
+    def valid_proof(cls, transactions, last_hash, proof):
+        return cls.__valid_guess(cls.proof_prefix(transactions, last_hash), proof)
+
+    @classmethod
+    def valid_block_proof(cls, block):
+        """ Checks the proof of work of a block by the rules of its version. """
+        if block.version == Block.LEGACY_VERSION:
+            # Excluding the last transaction, because that is the "reward" transaction
+            return cls.valid_proof(block.transactions[:-1], block.previous_hash, block.proof)
+        if block.version == Block.VERSION:
+            prefix = cls.header_prefix(block.index, block.previous_hash, block.merkle_root, block.timestamp, block.version)
+            return cls.__valid_guess(prefix, block.proof)
+        return False
+
+    @staticmethod
+    def valid_successor(block, previous_block):
+        """ Returns whether the block may follow the previous block: it has to link to its hash, take the next index and may not go back to an older version. """
+        return (block.previous_hash == previous_block.hash and block.index == previous_block.index + 1
+                and block.version >= previous_block.version)
+
+    @classmethod
+    def mark_verified(cls, block_hash):
+        """ Remembers that the block with the given hash carries a valid proof, so it isn't checked again. """
+        cls.__verified_hashes[block_hash] = True
+        cls.__verified_hashes.move_to_end(block_hash)
+        if len(cls.__verified_hashes) > cls.VERIFIED_CACHE_SIZE:
+            cls.__verified_hashes.popitem(last=False)
+
+    @classmethod
+    def forget_verified(cls):
+        """ Empties the cache of verified block hashes, so the next verification checks every proof again. """
+        cls.__verified_hashes.clear()
+
+    @classmethod
+    def __map(cls, function, blocks):
+        """ Applies a per-block function to all blocks, splitting large chains across a process pool. """
+        if len(blocks) < cls.PARALLEL_THRESHOLD:
+            return function(blocks)
+        if cls.__executor is None:
+            cls.__executor = ProcessPoolExecutor()
+        results = []
+        for chunk_result in cls.__executor.map(function, _chunks(blocks, cpu_count() or 1)):
+            results.extend(chunk_result)
+        return results
+
     @classmethod
     def verify_chain(cls, blockchain):
-        """ Verify the current blockchain and return True if it's valid, False otherwise. """
-        for index in range(1, len(blockchain)):
-            block = blockchain[index]
-            if block.previous_hash != hash_block(blockchain[index - 1]):
-                print('Previous hash does not match.')
-                return False
-            if not cls.valid_proof(block.transactions[:-1], block.previous_hash, block.proof):
+        """ Verify the current blockchain and return True if it's valid, False otherwise.
+
+        Block hashes and proofs don't depend on each other, so both are computed in parallel for long chains.
+        The proof of a block whose hash was verified before is not checked again: the hash covers the previous
+        hash, the transactions and the proof, so an unchanged hash means an unchanged outcome.
+
+        The chain may be any iterable of blocks, e.g. a StoredChain. It is verified in windows of WINDOW_SIZE
+        blocks, so a chain which is read from disk is never held in memory as a whole.
+        """
+        with metrics.VERIFY_CHAIN_SECONDS.time():
+            return cls.__verify_chain(blockchain)
+
+    @classmethod
+    def __verify_chain(cls, blockchain):
+        blocks = iter(blockchain)
+        # The first block is the genesis block or the anchor of a suffix, whose proof isn't checked
+        previous = next(blocks, None)
+        if previous is None:
+            return True
+        previous_hash = hash_block(previous)
+        window = list(islice(blocks, cls.WINDOW_SIZE))
+        while window:
+            hashes = cls.__map(_hash_blocks, window)
+            for block, block_hash in zip(window, hashes):
+                if block.previous_hash != previous_hash:
+                    print('Previous hash does not match.')
+                    return False
+                if block.index != previous.index + 1:
+                    print('Block index does not follow the previous block.')
+                    return False
+                if block.version < previous.version:
+                    print('Block version went back.')
+                    return False
+                previous, previous_hash = block, block_hash
+
+            proofs = cls.__map(_check_proofs, [block for block, block_hash in zip(window, hashes) if block_hash not in cls.__verified_hashes])
+            if not all(proofs):
                 print('Proof of work is invalid.')
                 return False
 
+            for block_hash in hashes:
+                cls.mark_verified(block_hash)
+            window = list(islice(blocks, cls.WINDOW_SIZE))
         return True
 
+    @staticmethod
+    def valid_transaction_data(transaction):
+        """ Returns whether the fields of a transaction have the right types: strings for the keys and the signature, a number for the amount. """
+        return (all(isinstance(value, str) for value in (transaction.sender, transaction.recipient, transaction.signature))
+                and isinstance(transaction.amount, (int, float)) and not isinstance(transaction.amount, bool))
+
     @staticmethod
     def verify_transaction(transaction, get_balance, check_funds=True):
         return (not check_funds or get_balance(transaction.sender) >= transaction.amount) and Wallet.verify_transaction(transaction)
-
-    @classmethod
-    def verify_transactions(cls, open_transactions, get_balance):
-        return all([cls.verify_transaction(tx, get_balance, False) for tx in open_transactions])
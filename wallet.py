@@ -1,12 +1,26 @@
+from collections import OrderedDict
+from threading import Lock
+
 from Crypto.Hash import SHA256
 from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5
 import Crypto.Random
 import binascii
 
+from utility import metrics
+
 
 class Wallet:
 
+    # Number of parsed public keys and of signature verification results which are kept around
+    KEY_CACHE_SIZE = 256
+    VERIFICATION_CACHE_SIZE = 100000
+
+    __key_cache = OrderedDict()
+    __verification_cache = OrderedDict()
+    __cache_lock = Lock()
+    __stats = {'key_hits': 0, 'key_misses': 0, 'verification_hits': 0, 'verification_misses': 0}
+
     def __init__(self, node_id):
         self.private_key, self.public_key = None, None
         self.node_id = node_id
@@ -47,9 +61,74 @@ class Wallet:
         signature = signer.sign(h)
         return binascii.hexlify(signature).decode('ascii')
 
-    @staticmethod
-    def verify_transaction(transaction):
-        public_key = RSA.importKey(binascii.unhexlify(transaction.sender))
-        verifier = PKCS1_v1_5.new(public_key)
-        h = SHA256.new((str(transaction.sender) + str(transaction.recipient) + str(transaction.amount)).encode('utf8'))
-        return verifier.verify(h, binascii.unhexlify(transaction.signature))
+    @classmethod
+    def __cache_get(cls, cache, key, stat):
+        with cls.__cache_lock:
+            if key in cache:
+                cache.move_to_end(key)
+                cls.__stats[stat + '_hits'] += 1
+                return cache[key]
+            cls.__stats[stat + '_misses'] += 1
+            return None
+
+    @classmethod
+    def __cache_put(cls, cache, key, value, size):
+        with cls.__cache_lock:
+            cache[key] = value
+            cache.move_to_end(key)
+            if len(cache) > size:
+                cache.popitem(last=False)
+
+    @classmethod
+    def __import_public_key(cls, sender):
+        """ Returns the parsed public key of a sender, using an LRU cache since a few senders dominate traffic. """
+        public_key = cls.__cache_get(cls.__key_cache, sender, 'key')
+        if public_key is None:
+            public_key = RSA.importKey(binascii.unhexlify(sender))
+            cls.__cache_put(cls.__key_cache, sender, public_key, cls.KEY_CACHE_SIZE)
+        return public_key
+
+    @classmethod
+    def verify_transaction(cls, transaction):
+        """ Verifies the signature of a transaction. The result is cached per transaction digest.
+
+        A sender which isn't a hex encoded key or a signature which isn't hex counts as an invalid signature.
+        """
+        valid = cls.__cache_get(cls.__verification_cache, transaction.digest, 'verification')
+        if valid is not None:
+            metrics.SIGNATURE_CACHE_HITS.inc()
+        else:
+            with metrics.SIGNATURE_SECONDS.time():
+                try:
+                    verifier = PKCS1_v1_5.new(cls.__import_public_key(transaction.sender))
+                    h = SHA256.new((str(transaction.sender) + str(transaction.recipient) + str(transaction.amount)).encode('utf8'))
+                    valid = verifier.verify(h, binascii.unhexlify(transaction.signature))
+                except (ValueError, TypeError, IndexError):
+                    valid = False
+            cls.__cache_put(cls.__verification_cache, transaction.digest, valid, cls.VERIFICATION_CACHE_SIZE)
+        return valid
+
+    @classmethod
+    def verify_transactions(cls, transactions):
+        """ Verifies the signatures of several transactions and returns one result per transaction.
+
+        Transactions which occur more than once in the batch are only verified once.
+        """
+        results = {}
+        for tx in transactions:
+            if tx.digest not in results:
+                results[tx.digest] = cls.verify_transaction(tx)
+        return [results[tx.digest] for tx in transactions]
+
+    @classmethod
+    def cache_stats(cls):
+        """ Returns the sizes, limits and hit/miss counters of the key and verification caches. """
+        with cls.__cache_lock:
+            stats = dict(cls.__stats)
+            stats.update({
+                'key_cache_size': len(cls.__key_cache),
+                'key_cache_limit': cls.KEY_CACHE_SIZE,
+                'verification_cache_size': len(cls.__verification_cache),
+                'verification_cache_limit': cls.VERIFICATION_CACHE_SIZE
+            })
+        return stats